@@ -1,16 +1,29 @@
+import time
+
+_import_started = time.perf_counter()
+
 import asyncio
+import csv
+import functools
 import os
 import random
 import sqlite3
-
-from dblite import aioDbLite
+import tempfile
+from typing import Optional
+
+from delivery import PrizeDelivery
+from journal import EventJournal, lottery_snapshot
+from pool import ClientPool, bot_id
+from storage import Storage
+from ratelimit import JoinGuard
 from dotenv import load_dotenv
 from pyrogram import Client, idle, filters
 from pyrogram.enums import ChatMemberStatus, ChatType, MessageEntityType
-from pyrogram.errors import MessageNotModified, ChatAdminRequired, MessageDeleteForbidden
-from pyrogram.handlers import MessageHandler
+from pyrogram.errors import MessageNotModified, ChatAdminRequired, MessageDeleteForbidden, FloodWait, RPCError
+from pyrogram.handlers import MessageHandler, CallbackQueryHandler, ChatMemberUpdatedHandler
 from pyrogram.handlers.handler import Handler
-from pyrogram.types import BotCommand, Message, ChatMember, Chat
+from pyrogram.types import BotCommand, Message, ChatMember, Chat, User, CallbackQuery, InlineKeyboardMarkup, \
+    InlineKeyboardButton, ChatMemberUpdated
 
 from utils import *
 
@@ -18,14 +31,35 @@ load_dotenv()
 API_ID = os.getenv('API_ID')
 API_HASH = os.getenv('API_HASH')
 BOT_TOKEN = os.getenv('BOT_TOKEN')
+# 多个机器人 token 以逗号分隔，未设置时使用 BOT_TOKEN
+BOT_TOKENS = [token.strip() for token in os.getenv('BOT_TOKENS', BOT_TOKEN or '').split(',') if token.strip()]
 ADMIN_ID = os.getenv('ADMIN_ID')
 BOT_PROXY = os.getenv('BOT_PROXY')
+# 会话文件存放目录，与数据库放在一起以便容器重启后复用授权
+SESSION_DIR = os.getenv('SESSION_DIR', 'db')
 APP_NAME = 'lotteries'
-
-
-async def _delete_temp_message(msg: Message, delay: int = 30):
-    await asyncio.sleep(delay)
-    await msg.delete()
+# 存储引擎 sqlite 或 memory，memory 模式按 SNAPSHOT_INTERVAL(秒) 定时保存快照
+STORAGE_ENGINE = os.getenv('STORAGE_ENGINE', 'sqlite')
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', 60))
+# sqlite 模式每 BACKUP_INTERVAL(秒) 备份到 db/lotteries.backup.db 供离线工具读取，0 表示不备份
+BACKUP_INTERVAL = int(os.getenv('BACKUP_INTERVAL', 3600))
+# 批量导入参与人员时每批写入的数量及进度刷新间隔(秒)
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_PROGRESS_INTERVAL = 3
+# 每个用户参与抽奖的令牌补充速度(个/秒)及最多累计的令牌数
+JOIN_RATE = float(os.getenv('JOIN_RATE', 0.1))
+JOIN_BURST = float(os.getenv('JOIN_BURST', 3))
+# 参与方式 button 按钮参与 password 发送口令参与 both 两者都可以
+JOIN_MODE = os.getenv('JOIN_MODE', 'both')
+# 开奖后是否主动私聊发送奖品，以及发送并发数和每秒最多发送数量
+PRIZE_DELIVERY = os.getenv('PRIZE_DELIVERY', 'false').lower() == 'true'
+DELIVERY_CONCURRENCY = int(os.getenv('DELIVERY_CONCURRENCY', 8))
+DELIVERY_RATE = float(os.getenv('DELIVERY_RATE', 20))
+# 参与后合并刷新置顶消息的间隔(秒)，间隔内的多次参与只编辑一次消息
+STATUS_REFRESH_DELAY = float(os.getenv('STATUS_REFRESH_DELAY', 2))
+# 启动恢复时每批重新渲染的置顶消息数量及批次间隔(秒)
+RERENDER_BATCH_SIZE = 20
+RERENDER_BATCH_DELAY = 1
 
 
 def member_is_admin(member: ChatMember) -> bool:
@@ -36,6 +70,23 @@ def chat_isin_group(chat: Chat):
     return chat.type == ChatType.GROUP or chat.type == ChatType.SUPERGROUP
 
 
+async def join_guard_filter(flt, _: Client, message: Message):
+    return bool(message.from_user) and flt.guard.allow(flt.lottery_id, message.from_user.id)
+
+
+def user_display_name(user: User) -> str:
+    username = user.username
+    if not username:
+        username = ' '.join(filter(lambda x: x and x.strip(), [user.first_name, user.last_name]))
+    return username or default_user_name(user.id)
+
+
+def join_keyboard(lottery: LotteryType) -> Optional[InlineKeyboardMarkup]:
+    if JOIN_MODE not in ['button', 'both'] or lottery['status'] != 1:
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton('🎁 参与抽奖', callback_data=f'join:{lottery["id"]}')]])
+
+
 def is_owner(lottery: LotteryType, message: Message):
     return lottery and lottery['creator_id'] == message.from_user.id
 
@@ -78,49 +129,199 @@ config_doc = f"""/create 创建一个抽奖(需要在群里发送)
 `/set password 参与口令` 设置参与口令
 `/set same_prize true` 设置奖品是否相同
 `/set prize 奖品`     设置奖品，多个则`shift+回车`输入多行
+`/import` 导入参与人员，发送CSV或JSONL文件并附带此命令
+`/export csv` 导出参与人员，格式为`csv`或`jsonl`
 /help   显示此帮助信息"""
 
 
 class LotteryBot(object):
-    aiodb: aioDbLite = None
+    storage: Storage = None
     app: Client = None
-    participant_handlers: dict[str, tuple[Handler, int]] = dict()
+    pool: ClientPool = None
+    participant_handlers: dict[str, Optional[tuple[Client, tuple[Handler, int]]]] = dict()
+    # 等待刷新的抽奖ID -> 已知的置顶消息
+    pending_refreshes: dict[int, Optional[Message]] = dict()
+    profiler: StartupProfiler = None
+    join_guard: JoinGuard = JoinGuard(JOIN_RATE, JOIN_BURST)
+    delivery: PrizeDelivery = None
+    journal: EventJournal = None
 
     async def init_server(self):
-        self.aiodb = await get_db_connect(APP_NAME)
-        await self.app.start()
-        print('[+] Service started successfully')
-        await self.app.set_bot_commands([
+        self.storage = await get_db_connect(APP_NAME, STORAGE_ENGINE, SNAPSHOT_INTERVAL, BACKUP_INTERVAL)
+        self.journal = EventJournal(self.storage).start()
+        self.profiler.mark('db open')
+        await self.pool.start()
+        self.profiler.mark('client start')
+        if PRIZE_DELIVERY:
+            self.delivery = PrizeDelivery(self.storage, self.pool.send_private, DELIVERY_CONCURRENCY, DELIVERY_RATE)
+            pending = await self.delivery.start()
+            print(f'[+] Prize delivery started, {pending} pending')
+        await self.recover_state()
+        self.profiler.mark('state recovery')
+        commands = [
             BotCommand('create', '创建抽奖'),
             BotCommand('help', '帮助信息'),
             BotCommand('info', '抽奖信息'),
             BotCommand('prize', '获取中奖奖品'),
             # BotCommand('clean', '清除全部信息'),
-        ])
+        ]
+        await asyncio.gather(*(client.set_bot_commands(commands) for client in self.pool.clients))
+        self.profiler.mark('command registration')
+        print(f'[+] Service started successfully\n{self.profiler.report()}')
         await idle()
-        await self.app.stop()
-        await self.aiodb.close()
-
-    def start_server(self):
-        self.app = Client(
-            APP_NAME,
-            api_id=API_ID,
-            api_hash=API_HASH,
-            bot_token=BOT_TOKEN,
-            in_memory=True,
-            proxy=url2dict(BOT_PROXY)
-        )
-        self.app.add_handler(MessageHandler(self.send_helper_message, filters.command(['start', 'help'])))
-        self.app.add_handler(MessageHandler(self.create_lottery_handler, filters.command(['create'])))
-        self.app.add_handler(MessageHandler(self.set_lottery_handler, filters.command(['set'])))
-        self.app.add_handler(MessageHandler(self.read_lottery_handler, filters.command(['info'])))
-        self.app.add_handler(MessageHandler(self.manage_lottery_handler, filters.command(['manage'])))
-        self.app.add_handler(MessageHandler(self.get_prize_handler, filters.command(['prize'])))
-        # self.app.add_handler(MessageHandler(delete_all_message, filters.command(['clean'])))
+        self.delivery and (await self.delivery.stop())
+        await self.journal.stop()
+        await self.pool.stop()
+        await self.storage.close()
+
+    def start_server(self, profiler: StartupProfiler = None):
+        self.profiler = profiler or StartupProfiler()
+        os.makedirs(SESSION_DIR, exist_ok=True)
+        clients = []
+        for bot_token in BOT_TOKENS:
+            client = Client(
+                # 已授权的会话会忽略 bot_token，按机器人ID命名会话，更换或调整 token 顺序时不会登录成其它机器人
+                f'{APP_NAME}_{bot_id(bot_token)}',
+                api_id=API_ID,
+                api_hash=API_HASH,
+                bot_token=bot_token,
+                workdir=SESSION_DIR,
+                proxy=url2dict(BOT_PROXY)
+            )
+            client.add_handler(MessageHandler(self.send_helper_message, filters.command(['start', 'help'])))
+            client.add_handler(MessageHandler(self.create_lottery_handler, filters.command(['create'])))
+            client.add_handler(MessageHandler(self.set_lottery_handler, filters.command(['set'])))
+            client.add_handler(MessageHandler(self.read_lottery_handler, filters.command(['info'])))
+            client.add_handler(MessageHandler(self.manage_lottery_handler, filters.command(['manage'])))
+            client.add_handler(MessageHandler(self.get_prize_handler, filters.command(['prize'])))
+            client.add_handler(MessageHandler(self.import_participants_handler, filters.command(['import'])))
+            client.add_handler(MessageHandler(self.export_participants_handler, filters.command(['export'])))
+            client.add_handler(CallbackQueryHandler(self.join_callback_handler, filters.regex(r'^join:(\d+)$')))
+            client.add_handler(ChatMemberUpdatedHandler(self.bot_member_handler))
+            # client.add_handler(MessageHandler(delete_all_message, filters.command(['clean'])))
+            clients.append(client)
+        self.pool = ClientPool(clients)
+        self.app = self.pool.primary
         self.app.run(self.init_server())
 
+    async def recover_state(self):
+        started = time.perf_counter()
+        lotteries = await load_lotteries_by_status(self.storage, [1, 3])
+        running = [lottery for lottery in lotteries if lottery['status'] == 1]
+        drawing = [lottery for lottery in lotteries if lottery['status'] == 3]
+        await self.pool.resolve_all(lottery['chat_id'] for lottery in lotteries)
+        self.profiler.mark('owner resolve')
+        for lottery in running:
+            await self._register_participant_handler(lottery)
+        for lottery in drawing:
+            await self._recover_draw(lottery)
+        temp_messages = await load_temp_messages(self.storage)
+        now = int(time.time())
+        for temp in temp_messages:
+            asyncio.create_task(self._delete_chat_message(temp['chat_id'], temp['message_id'],
+                                                          max(0, temp['delete_at'] - now)))
+        asyncio.create_task(self._rerender_status_messages(running))
+        print(f'[+] Recovered {len(running)} running lotteries, {len(drawing)} interrupted draws, '
+              f'{len(temp_messages)} pending deletes in {time.perf_counter() - started:.3f}s')
+
+    async def _recover_draw(self, lottery: LotteryType):
+        try:
+            message = await self._get_status_message(lottery)
+        except RPCError as e:
+            # 消息无法获取时仍需完成开奖，避免抽奖一直处于开奖中
+            print(f'[-] Load status message of lottery {lottery["id"]} failed: {e}')
+            message = None
+        try:
+            await self._finish_draw(lottery['id'], message)
+        except RPCError as e:
+            # 中奖信息已写入，只是无法公布结果(如机器人已被移出群组)，不能阻塞其它抽奖的恢复和启动
+            print(f'[-] Announce result of lottery {lottery["id"]} failed: {e}')
+
+    async def _rerender_status_messages(self, lotteries: list[LotteryType]):
+        started = time.perf_counter()
+        for index in range(0, len(lotteries), RERENDER_BATCH_SIZE):
+            for lottery in lotteries[index: index + RERENDER_BATCH_SIZE]:
+                participants = await load_participants(self.storage, lottery['id'])
+                text = lottery_status2message(lottery, participants)
+                client = await self.pool.resolve(lottery['chat_id'])
+                try:
+                    await client.edit_message_text(lottery['chat_id'], lottery['message_id'], text,
+                                                   reply_markup=join_keyboard(lottery))
+                except FloodWait as e:
+                    await asyncio.sleep(e.value)
+                except (MessageNotModified, RPCError):
+                    pass
+            await asyncio.sleep(RERENDER_BATCH_DELAY)
+        print(f'[+] Re-rendered {len(lotteries)} status messages in {time.perf_counter() - started:.3f}s')
+
+    async def _get_status_message(self, lottery: LotteryType) -> Message:
+        client = await self.pool.resolve(lottery['chat_id'])
+        chat_message = await client.get_messages(lottery['chat_id'], lottery['message_id'])
+        if chat_message.empty:
+            chat_message.chat and (await chat_message.delete())
+            chat_message = await client.send_message(lottery['chat_id'], "/empty")
+            await set_lottery(self.storage, lottery['id'], message_id=chat_message.id)
+        return chat_message
+
+    async def _register_participant_handler(self, lottery: LotteryType):
+        handler_key = f'{lottery["chat_id"]}_{lottery["creator_id"]}'
+        if handler_key in self.participant_handlers:
+            return
+        await self._load_join_guard(lottery['id'])
+        if JOIN_MODE not in ['password', 'both']:
+            self.participant_handlers[handler_key] = None
+            return
+        # 只在负责该群组的机器人上注册，避免多个机器人重复处理
+        client = await self.pool.resolve(lottery['chat_id'])
+        self.participant_handlers[handler_key] = client, client.add_handler(MessageHandler(
+            functools.partial(self.add_participant_handler, lottery_id=lottery['id']),
+            filters.chat(lottery['chat_id']) & filters.regex(rf'\$\${lottery["password"]}') & filters.create(
+                join_guard_filter, guard=self.join_guard, lottery_id=lottery['id'])
+        ))
+
+    def _remove_participant_handler(self, lottery: LotteryType):
+        handler_key = f'{lottery["chat_id"]}_{lottery["creator_id"]}'
+        handler = self.participant_handlers.pop(handler_key, None)
+        if handler:
+            client, handler = handler
+            client.remove_handler(*handler)
+        self.join_guard.forget(lottery['id'])
+
+    async def _load_join_guard(self, lottery_id: int):
+        participants = await load_participants(self.storage, lottery_id)
+        self.join_guard.load(lottery_id, map(lambda x: x['user_id'], participants))
+
+    async def _delete_temp_message(self, msg: Message, delay: int = 30):
+        await add_temp_message(self.storage, msg.chat.id, msg.id, int(time.time()) + delay)
+        await self._delete_chat_message(msg.chat.id, msg.id, delay)
+
+    async def _delete_chat_message(self, chat_id: int, message_id: int, delay: int = 0):
+        await asyncio.sleep(delay)
+        try:
+            await (await self.pool.resolve(chat_id)).delete_messages(chat_id=chat_id, message_ids=message_id)
+        except RPCError:
+            pass
+        finally:
+            await remove_temp_message(self.storage, chat_id, message_id)
+
+    async def bot_member_handler(self, _: Client, update: ChatMemberUpdated):
+        member = update.new_chat_member or update.old_chat_member
+        if member is None or member.user is None or not member.user.is_self:
+            return
+        # 机器人被移出群组或管理员权限变化时重新确定负责该群组的机器人
+        chat_id = update.chat.id
+        owner = self.pool.owners.get(chat_id)
+        self.pool.forget(chat_id)
+        lottery = await load_lottery(self.storage, chat_id, [1])
+        if owner is None or lottery is None:
+            return
+        if (await self.pool.resolve(chat_id)) is not owner:
+            self._remove_participant_handler(lottery)
+            await self._register_participant_handler(lottery)
+
     async def check_allow(self, chat_id: int, user_id: int):
-        member = await self.app.get_chat_member(chat_id=chat_id, user_id=user_id)
+        client = await self.pool.resolve(chat_id)
+        member = await client.get_chat_member(chat_id=chat_id, user_id=user_id)
         return member_is_admin(member)
 
     async def send_helper_message(self, client: Client, message: Message):
@@ -141,6 +342,8 @@ class LotteryBot(object):
             await message.reply('请在群里发送此命令')
             return self
         chat_id = chat.id
+        if (await self.pool.resolve(chat_id)) is not client:
+            return self
         user_id = message.from_user.id
         _bot = await client.get_me()
         if not (await self.check_allow(chat_id, user_id)):
@@ -149,11 +352,11 @@ class LotteryBot(object):
         if not member_is_admin(bot_member):
             await message.reply('请先将我设置成管理员')
             return self
-        old_lottery = await load_lottery(self.aiodb, chat_id)
+        old_lottery = await load_lottery(self.storage, chat_id)
         if old_lottery:
             _temp_message = await client.send_message(chat_id, '**存在未结束的抽奖**',
                                                       reply_to_message_id=old_lottery['message_id'])
-            await asyncio.create_task(_delete_temp_message(_temp_message, 5))
+            await asyncio.create_task(self._delete_temp_message(_temp_message, 5))
             return self
         username = message.from_user.username
         if not username:
@@ -162,12 +365,13 @@ class LotteryBot(object):
         title = message.command[1] if len(message.command) > 1 else '送天卡'
         text = f'创建抽奖成功，请查看[私聊](https://t.me/{_bot.username})信息设置抽奖内容'
         send_message = await client.send_message(chat_id, text)
-        await asyncio.create_task(_delete_temp_message(message, 5))
-        await add_lottery(self.aiodb, chat_id, send_message.id, title, creator_id=message.from_user.id)
-        lottery = await load_lottery(self.aiodb, chat_id)
+        await asyncio.create_task(self._delete_temp_message(message, 5))
+        await add_lottery(self.storage, chat_id, send_message.id, title, creator_id=message.from_user.id)
+        lottery = await load_lottery(self.storage, chat_id)
         if not lottery:
             await send_message.edit_text('创建抽奖失败，请检查服务')
             return self
+        self.journal.record('created', lottery['id'], chat_id, lottery_snapshot(lottery))
         try:
             invite_link = await chat.export_invite_link()
         except ChatAdminRequired:
@@ -189,7 +393,7 @@ class LotteryBot(object):
         if chat_id is None:
             await message.reply('请先创建抽奖')
             return None, None
-        lottery = await load_lottery(self.aiodb, chat_id)
+        lottery = await load_lottery(self.storage, chat_id)
         if lottery is None or not is_owner(lottery, message):
             await message.reply('请先创建抽奖')
             return None, None
@@ -232,8 +436,10 @@ class LotteryBot(object):
         if fn is None:
             await message.reply(f'**参数错误**\n你可以使用以下命令:\n{config_doc}')
             return self
-        await set_lottery(self.aiodb, lottery['id'], **{prop: fn(args)})
-        lottery = await load_lottery(self.aiodb, chat_id)
+        value = fn(args)
+        await set_lottery(self.storage, lottery['id'], **{prop: value})
+        self.journal.record('configured', lottery['id'], chat_id, {prop: value})
+        lottery = await load_lottery(self.storage, chat_id)
         text = f"""**设置成功**
 {int2number(1)} 你可以使用以下命令:
 {config_doc}
@@ -249,7 +455,9 @@ class LotteryBot(object):
             return self
         if not (await self.check_allow(chat_id, message.from_user.id)):
             return self
-        await message.reply(f'**当前抽奖信息**\n{lottery2message(lottery, True)}')
+        stats = self.join_guard.stats(lottery['id'])
+        await message.reply(f'**当前抽奖信息**\n{lottery2message(lottery, True)}\n'
+                            f'拦截重复参与：`{stats["duplicate"]}`\n拦截频繁参与：`{stats["flood"]}`')
         return self
 
     async def manage_lottery_handler(self, client: Client, message: Message):
@@ -266,21 +474,11 @@ class LotteryBot(object):
             'draw': lambda *args: self.draw_lottery(*args),
         }
         fn = manage_cmd.get(cmd)
-        handler_key = f'{chat_id}_{message.from_user.id}'
-        handler = self.participant_handlers.get(handler_key)
-        if cmd == 'start' and handler is None:
-            self.participant_handlers[handler_key] = self.app.add_handler(MessageHandler(
-                self.add_participant_handler,
-                filters.chat(lottery['chat_id']) & filters.regex(rf'\$\${lottery["password"]}')
-            ))
-        elif cmd in ['pause', 'cancel', 'draw'] and handler:
-            self.app.remove_handler(*handler)
-            del self.participant_handlers[handler_key]
-        chat_message = await client.get_messages(chat_id, lottery['message_id'])
-        if chat_message.empty:
-            chat_message.chat and (await chat_message.delete())
-            chat_message = await client.send_message(chat_id, "/empty")
-            await set_lottery(self.aiodb, lottery['id'], message_id=chat_message.id)
+        if cmd == 'start':
+            await self._register_participant_handler(lottery)
+        elif cmd in ['pause', 'cancel', 'draw']:
+            self._remove_participant_handler(lottery)
+        chat_message = await self._get_status_message(lottery)
         if fn is None:
             await message.reply(f'**无效的命令**\n你可以使用以下命令:\n{config_doc}')
             return self
@@ -295,23 +493,30 @@ class LotteryBot(object):
 
     async def start_lottery(self, lottery: LotteryType, message: Message):
         lottery_id = lottery['id']
-        await set_lottery(self.aiodb, lottery_id, status=1)
-        lottery = await load_lottery_by_id(self.aiodb, lottery_id)
-        participants = await load_participants(self.aiodb, lottery_id)
-        await message.edit_text(lottery_status2message(lottery, participants))
+        await set_lottery(self.storage, lottery_id, status=1)
+        self.journal.record('started', lottery_id, lottery['chat_id'])
+        lottery = await load_lottery_by_id(self.storage, lottery_id)
+        participants = await load_participants(self.storage, lottery_id)
+        await message.edit_text(lottery_status2message(lottery, participants), reply_markup=join_keyboard(lottery))
         pined = await message.pin()
         pined and (await pined.delete())
         return lottery
 
     async def draw_lottery(self, lottery: LotteryType, message: Message):
-        if lottery['status'] == 2:
+        if lottery['status'] in (2, 3):
             if message.text == '/empty':
                 await message.delete()
             return lottery
         lottery_id = lottery['id']
-        await set_lottery(self.aiodb, lottery_id, status=2)
-        lottery = await load_lottery_by_id(self.aiodb, lottery_id)
-        participants = await load_participants(self.aiodb, lottery_id)
+        # 先标记为开奖中，中奖信息写入完成后才标记为已结束，便于重启后恢复
+        # 只有从暂停或抽奖中切换成功的一方继续开奖，避免同时达到开奖人数时重复开奖
+        if not (await swap_lottery_status(self.storage, lottery_id, 3, [0, 1])):
+            return await load_lottery_by_id(self.storage, lottery_id)
+        return await self._finish_draw(lottery_id, message)
+
+    async def _finish_draw(self, lottery_id: int, message: Optional[Message]):
+        lottery = await load_lottery_by_id(self.storage, lottery_id)
+        participants = await load_participants(self.storage, lottery_id)
         winner_people = lottery['winner_people']
         if winner_people.isdigit():
             sample_count = int(winner_people)
@@ -319,28 +524,49 @@ class LotteryBot(object):
             sample_count = len(participants) * int(winner_people.split('%')[0]) / 100
         else:
             sample_count = len(participants) / 2
-        winners = random.sample(participants, k=int(sample_count))
-        prize = [lottery['prize']] * len(winners) if lottery['same_prize'] else lottery['prize']
+        winners = random.sample(participants, k=min(int(sample_count), len(participants)))
+        prize = [lottery['prize']] * len(winners) if lottery['same_prize'] else list(lottery['prize'])
         _empty = '无奖品，请联系抽奖发布者'
-        for winner in winners:
-            await set_winner_prize(self.aiodb, winner['id'], prize.pop() if len(prize) else _empty)
-        _bot = await self.app.get_me()
+        assigned = [(winner, prize.pop() if len(prize) else _empty) for winner in winners]
+        await set_winners_prize(self.storage, lottery_id, [(winner['id'], _prize) for winner, _prize in assigned])
+        # 在标记为已结束前写入发送记录，开奖中断时随恢复流程重新生成
+        self.delivery and (await add_deliveries(self.storage, lottery_id))
+        await set_lottery(self.storage, lottery_id, status=2)
+        # 发送记录已写入，先加入发送队列，后续公布结果失败时不影响发送奖品
+        self.delivery and asyncio.create_task(self.delivery.enqueue_lottery(lottery_id))
+        self.journal.record('drawn', lottery_id, lottery['chat_id'], dict(
+            winners=[[winner['user_id'], winner['user_name'], _prize] for winner, _prize in assigned]))
+        lottery = await load_lottery_by_id(self.storage, lottery_id)
+        self._remove_participant_handler(lottery)
+        client = await self.pool.resolve(lottery['chat_id'])
+        _bot = await client.get_me()
         msg = lottery_winner2message(lottery, participants, winners, _bot)
-        await message.edit_text(msg)
-        await self.app.send_message(chat_id=message.chat.id, text=msg)
+        if message is not None:
+            await self._retry_flood(message.edit_text, msg)
+        await self._retry_flood(client.send_message, chat_id=lottery['chat_id'], text=msg)
         return lottery
 
+    @staticmethod
+    async def _retry_flood(call, *args, **kwargs):
+        # 开奖结果只公布一次，被限流时等待后重试一次
+        try:
+            return await call(*args, **kwargs)
+        except FloodWait as e:
+            await asyncio.sleep(e.value)
+            return await call(*args, **kwargs)
+
     async def pause_lottery(self, lottery: LotteryType, message: Message):
         same = lottery['status'] == 0
         lottery_id = lottery['id']
-        await set_lottery(self.aiodb, lottery_id, status=0)
-        lottery = await load_lottery_by_id(self.aiodb, lottery_id)
-        participants = await load_participants(self.aiodb, lottery_id)
+        await set_lottery(self.storage, lottery_id, status=0)
+        same or self.journal.record('paused', lottery_id, lottery['chat_id'])
+        lottery = await load_lottery_by_id(self.storage, lottery_id)
+        participants = await load_participants(self.storage, lottery_id)
         await message.edit(lottery_status2message(lottery, participants))
         if same:
             return lottery
         _temp_message = await message.reply('**抽奖已暂停，消息将在30秒后删除**')
-        await asyncio.create_task(_delete_temp_message(_temp_message))
+        await asyncio.create_task(self._delete_temp_message(_temp_message))
         return lottery
 
     async def cancel_lottery(self, lottery: LotteryType, message: Message):
@@ -352,48 +578,194 @@ class LotteryBot(object):
         lottery['status'] = 2
         await message.edit(lottery_status2message(lottery, []))
         await message.unpin()
-        await remove_lottery_by_id(self.aiodb, lottery_id)
+        await remove_lottery_by_id(self.storage, lottery_id)
+        self.journal.record('cancelled', lottery_id, lottery['chat_id'], lottery_snapshot(lottery))
         _temp_message = await message.reply('**抽奖已取消，消息将在30秒后删除**')
-        await asyncio.create_task(_delete_temp_message(_temp_message))
-        await asyncio.create_task(_delete_temp_message(message))
+        await asyncio.create_task(self._delete_temp_message(_temp_message))
+        await asyncio.create_task(self._delete_temp_message(message))
+
+    def _schedule_refresh(self, lottery_id: int, message: Optional[Message] = None):
+        if lottery_id in self.pending_refreshes:
+            self.pending_refreshes[lottery_id] = message or self.pending_refreshes[lottery_id]
+            return
+        self.pending_refreshes[lottery_id] = message
+        asyncio.create_task(self._delayed_refresh(lottery_id))
+
+    async def _delayed_refresh(self, lottery_id: int):
+        await asyncio.sleep(STATUS_REFRESH_DELAY)
+        message = self.pending_refreshes.pop(lottery_id, None)
+        try:
+            await self._refresh_status_message(lottery_id, message)
+        except FloodWait as e:
+            # 限流结束后再刷新一次，期间的参与继续合并
+            await asyncio.sleep(e.value)
+            self._schedule_refresh(lottery_id, message)
+        except RPCError as e:
+            print(f'[-] Refresh status message of lottery {lottery_id} failed: {e}')
+
+    async def _refresh_status_message(self, lottery_id: int, message: Optional[Message] = None):
+        lottery = await load_lottery_by_id(self.storage, lottery_id)
+        if lottery is None or lottery['status'] != 1:
+            return
+        participants = await load_participants(self.storage, lottery_id)
+        text = lottery_status2message(lottery, participants)
+        client = await self.pool.resolve(lottery['chat_id'])
+        if message is not None and message.id == lottery['message_id']:
+            # 按钮回调中的消息就是置顶消息，直接编辑，省去一次 get_messages
+            chat_message = message
+        else:
+            chat_message = await client.get_messages(lottery['chat_id'], lottery['message_id'])
+        if chat_message.empty:
+            chat_message.chat and (await chat_message.delete())
+            chat_message = await client.send_message(lottery['chat_id'], text, reply_markup=join_keyboard(lottery))
+            await set_lottery(self.storage, lottery['id'], message_id=chat_message.id)
+        else:
+            try:
+                await chat_message.edit_text(text, reply_markup=join_keyboard(lottery))
+            except MessageNotModified:
+                pass
+
+    async def _check_auto_draw(self, lottery_id: int, message: Optional[Message] = None):
+        # 参与成功后立即检查是否达到开奖人数，不等待合并刷新，开奖的错误也不交给刷新流程处理
+        lottery = await load_lottery_by_id(self.storage, lottery_id)
+        if lottery is None or lottery['status'] != 1:
+            return
+        drawn_people = lottery['drawn_people'] or 0
+        # 先用内存中的参与用户粗略判断，达到人数后再查询数据库确认
+        if not (0 < drawn_people <= len(self.join_guard.seen.get(lottery_id, ()))):
+            return
+        if len(await load_participants(self.storage, lottery_id)) < drawn_people:
+            return
+        # 立即停止接受参与，减少开奖前多出的参与人数
+        self._remove_participant_handler(lottery)
+        if message is None or message.id != lottery['message_id']:
+            try:
+                message = await self._get_status_message(lottery)
+            except RPCError as e:
+                print(f'[-] Load status message of lottery {lottery_id} failed: {e}')
+                message = None
+        try:
+            await self.draw_lottery(lottery, message)
+        except RPCError as e:
+            print(f'[-] Announce result of lottery {lottery_id} failed: {e}')
+
+    async def join_callback_handler(self, _: Client, query: CallbackQuery):
+        lottery_id = int(query.matches[0].group(1))
+        user = query.from_user
+        if lottery_id not in self.join_guard.seen:
+            await query.answer('没有正在进行的抽奖')
+            return self
+        if not self.join_guard.allow(lottery_id, user.id):
+            joined = user.id in self.join_guard.seen.get(lottery_id, ())
+            await query.answer('你已经参与过此抽奖' if joined else '操作太频繁，请稍后再试')
+            return self
+        try:
+            username = user_display_name(user)
+            await add_participant(self.storage, user_id=user.id, user_name=username, lottery_id=lottery_id)
+        except sqlite3.IntegrityError:
+            await query.answer('你已经参与过此抽奖')
+            return self
+        except sqlite3.Error as e:
+            # 未写入成功，允许用户重新参与
+            self.join_guard.discard(lottery_id, user.id)
+            print(f'[-] Add participant to lottery {lottery_id} failed: {e}')
+            await query.answer('参与失败，请稍后再试')
+            return self
+        self.journal.record('joined', lottery_id, query.message.chat.id, dict(users=[[user.id, username]]))
+        await query.answer('参与抽奖成功')
+        self._schedule_refresh(lottery_id, query.message)
+        await self._check_auto_draw(lottery_id, query.message)
+        return self
 
-    async def add_participant_handler(self, client: Client, message: Message):
+    async def add_participant_handler(self, client: Client, message: Message, lottery_id: int):
         user = message.from_user
         chat = message.chat
         user_id = user.id
-        username = user.username
+        username = user_display_name(user)
         _temp_message = None
-        if not username:
-            username = ' '.join(filter(lambda x: x and x.strip(), [user.first_name, user.last_name]))
-        if not username:
-            username = 'U%x' % user_id
+        joined = False
         try:
             if not username:
                 _temp_message = await message.reply(f'需要设置用户名才能参与抽奖')
                 return self
-            lottery_id = await add_participant(self.aiodb, user_id=user_id, user_name=username, chat_id=chat.id)
-            if lottery_id is None:
+            joined_lottery_id = await add_participant(self.storage, user_id=user_id, user_name=username,
+                                                      chat_id=chat.id)
+            if joined_lottery_id is None:
                 _temp_message = await message.reply(f'没有正在进行的抽奖')
                 return self
+            joined = True
+            self.journal.record('joined', joined_lottery_id, chat.id, dict(users=[[user_id, username]]))
             _temp_message = await message.reply(f'@{username} 参与抽奖成功')
-            lottery = await load_lottery_by_id(self.aiodb, lottery_id)
-            participants = await load_participants(self.aiodb, lottery_id)
-            chat_message = await client.get_messages(lottery['chat_id'], lottery['message_id'])
-            text = lottery_status2message(lottery, participants)
-            if chat_message.empty:
-                chat_message.chat and (await chat_message.delete())
-                chat_message = await client.send_message(lottery['chat_id'], text)
-                await set_lottery(self.aiodb, lottery['id'], message_id=chat_message.id)
-            else:
-                await chat_message.edit(text)
-            # 自动开奖
-            if 0 < lottery['drawn_people'] <= len(participants):
-                await self.draw_lottery(lottery, chat_message)
+            self._schedule_refresh(joined_lottery_id)
+            await self._check_auto_draw(joined_lottery_id)
         except sqlite3.IntegrityError:
-            pass
+            joined = True
+        except sqlite3.Error as e:
+            print(f'[-] Add participant to lottery {lottery_id} failed: {e}')
         finally:
-            _temp_message and asyncio.create_task(_delete_temp_message(_temp_message, 5))
-            await asyncio.create_task(_delete_temp_message(message, 5))
+            # join_guard_filter 已记录该用户，未写入成功时移除，允许重新参与
+            joined or self.join_guard.discard(lottery_id, user_id)
+            _temp_message and asyncio.create_task(self._delete_temp_message(_temp_message, 5))
+            await asyncio.create_task(self._delete_temp_message(message, 5))
+        return self
+
+    async def import_participants_handler(self, client: Client, message: Message):
+        chat_id, lottery = await self._get_current_lottery(client, message)
+        if lottery is None:
+            return self
+        if not (await self.check_allow(chat_id, message.from_user.id)):
+            return self
+        document = message.document or (message.reply_to_message and message.reply_to_message.document)
+        if document is None:
+            await message.reply('请发送CSV或JSONL文件并附带`/import`命令')
+            return self
+        progress_message = await message.reply('**正在导入参与人员...**')
+        last_report = time.perf_counter()
+
+        async def report(total: int, inserted: int):
+            nonlocal last_report
+            if time.perf_counter() - last_report < IMPORT_PROGRESS_INTERVAL:
+                return
+            last_report = time.perf_counter()
+            try:
+                await progress_message.edit_text(f'**正在导入参与人员...**\n已读取：`{total}`\n已导入：`{inserted}`')
+            except (MessageNotModified, FloodWait):
+                pass
+
+        with tempfile.TemporaryDirectory() as workdir:
+            path = await client.download_media(document, file_name=f'{workdir}/{document.file_name or "import.csv"}')
+            try:
+                total, inserted = await import_participants(
+                    self.storage, lottery['id'], read_participant_rows(path), IMPORT_CHUNK_SIZE, report,
+                    lambda inserted_rows: self.journal.record('joined', lottery['id'], chat_id, dict(
+                        users=[list(row) for row in inserted_rows])))
+            except (ValueError, UnicodeDecodeError, OverflowError, csv.Error):
+                await progress_message.edit_text('**文件格式错误**')
+                return self
+            except sqlite3.Error as e:
+                print(f'[-] Import participants of lottery {lottery["id"]} failed: {e}')
+                await progress_message.edit_text('**导入失败，请稍后重试**')
+                return self
+        if lottery['id'] in self.join_guard.seen:
+            await self._load_join_guard(lottery['id'])
+        await progress_message.edit_text(
+            f'**导入完成**\n已读取：`{total}`\n已导入：`{inserted}`\n重复忽略：`{total - inserted}`')
+        return self
+
+    async def export_participants_handler(self, client: Client, message: Message):
+        chat_id, lottery = await self._get_current_lottery(client, message)
+        if lottery is None:
+            return self
+        if not (await self.check_allow(chat_id, message.from_user.id)):
+            return self
+        fmt = message.command[1] if len(message.command) > 1 else 'csv'
+        if fmt not in ['csv', 'jsonl']:
+            await message.reply('**参数错误**\n`/export csv` 或 `/export jsonl`')
+            return self
+        with tempfile.TemporaryDirectory() as workdir:
+            path = f'{workdir}/participants_{lottery["id"]}.{fmt}'
+            count = await export_participants(self.storage, lottery['id'], path)
+            await message.reply_document(path, caption=f'参与人数：`{int2number(count)}`')
         return self
 
     async def get_prize_handler(self, client: Client, message: Message):
@@ -401,24 +773,26 @@ class LotteryBot(object):
         if chat.type != ChatType.PRIVATE:
             return self
         user_id = message.from_user.id
-        winner = await get_winner_by_user(self.aiodb, user_id)
-        if winner is None or winner['prize'] is None:
+        lottery_id, title, prize = await get_prize_by_user(self.storage, user_id)
+        if prize is None:
             await message.reply('没有中奖信息')
             return self
-        lottery = await load_lottery_by_id(self.aiodb, winner['lottery_id'])
-        if lottery is None:
+        if title is None:
             await message.reply('没有抽奖信息')
             return self
-        await message.reply(prize2message(lottery['title'], winner['prize']))
+        await message.reply(prize2message(title, prize))
+        self.journal.record('prize_claimed', lottery_id, None, dict(user_id=user_id))
         return self
 
 
 if __name__ == '__main__':
+    startup_profiler = StartupProfiler(_import_started)
+    startup_profiler.mark('import')
     bot = LotteryBot()
     try:
         print('[*] Starting service...')
-        bot.start_server()
+        bot.start_server(startup_profiler)
     except KeyboardInterrupt:
         loop = asyncio.get_event_loop()
         loop.call_later(0, lambda _: print('[+] Service stopped'), None)
-        loop.run_until_complete(bot.aiodb.close())
+        loop.run_until_complete(bot.storage.close())
@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from dblite import dbLite, aioDbLite
+from journal import EventJournal
+from ratelimit import JoinGuard
+from storage import PARTICIPANTS, PARTICIPANT_COLUMNS, Storage, SqliteStorage, MemoryStorage
+
+OPERATIONS = ['bulk', 'add', 'select', 'update', 'count']
+
+
+def create_schema(db: dbLite):
+    db.create(PARTICIPANTS, **PARTICIPANT_COLUMNS)
+    db.cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS idx_unique_users_lottery ON {PARTICIPANTS} '
+                      f'(user_id, user_name, lottery_id);')
+    db.cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_participants_lottery ON {PARTICIPANTS} (lottery_id);')
+
+
+def make_rows(size: int, start: int = 0) -> list[tuple]:
+    # 每个抽奖 1000 人，与线上参与人员表的分布接近
+    return [(user_id, f'U{user_id:x}', user_id // 1000) for user_id in range(start, start + size)]
+
+
+def summary(op: str, samples: list[float], count: int = None) -> dict:
+    total = sum(samples)
+    count = count or len(samples)
+    if len(samples) == 1:
+        p50 = p99 = total / count
+    else:
+        quantiles = statistics.quantiles(samples, n=100)
+        p50, p99 = quantiles[49], quantiles[98]
+    return dict(op=op, ops=count / total if total else 0, p50=p50 * 1e6, p99=p99 * 1e6)
+
+
+def bench_sync(path: str, size: int, ops: int, seed: int) -> list[dict]:
+    rng = random.Random(seed)
+    db = dbLite(path)
+    try:
+        create_schema(db)
+        results = []
+        started = time.perf_counter()
+        db.add_many(PARTICIPANTS, ('user_id', 'user_name', 'lottery_id'), make_rows(size))
+        results.append(summary('bulk', [time.perf_counter() - started], size))
+        samples = []
+        for user_id in range(size, size + ops):
+            started = time.perf_counter()
+            db.add(PARTICIPANTS, user_id=user_id, user_name=f'U{user_id:x}', lottery_id=user_id // 1000)
+            samples.append(time.perf_counter() - started)
+        results.append(summary('add', samples))
+        samples = []
+        for _ in range(ops):
+            user_id = rng.randrange(size)
+            started = time.perf_counter()
+            db.select(PARTICIPANTS, '*', user_id=user_id)
+            samples.append(time.perf_counter() - started)
+        results.append(summary('select', samples))
+        samples = []
+        for _ in range(ops):
+            participant_id = rng.randrange(1, size + 1)
+            started = time.perf_counter()
+            db.update(PARTICIPANTS, prize='bench', id=participant_id)
+            samples.append(time.perf_counter() - started)
+        results.append(summary('update', samples))
+        samples = []
+        for _ in range(ops):
+            started = time.perf_counter()
+            db.count_list(PARTICIPANTS)
+            samples.append(time.perf_counter() - started)
+        results.append(summary('count', samples))
+        return results
+    finally:
+        db.close()
+
+
+async def bench_async(path: str, size: int, ops: int, seed: int) -> list[dict]:
+    rng = random.Random(seed)
+    # 建表不计入耗时，使用同步连接完成后再以异步方式打开
+    with dbLite(path) as db:
+        create_schema(db)
+    db = await aioDbLite(path)
+    try:
+        results = []
+        started = time.perf_counter()
+        await db.add_many(PARTICIPANTS, ('user_id', 'user_name', 'lottery_id'), make_rows(size))
+        results.append(summary('bulk', [time.perf_counter() - started], size))
+        samples = []
+        for user_id in range(size, size + ops):
+            started = time.perf_counter()
+            await db.add(PARTICIPANTS, user_id=user_id, user_name=f'U{user_id:x}', lottery_id=user_id // 1000)
+            samples.append(time.perf_counter() - started)
+        results.append(summary('add', samples))
+        samples = []
+        for _ in range(ops):
+            user_id = rng.randrange(size)
+            started = time.perf_counter()
+            await db.select(PARTICIPANTS, '*', user_id=user_id)
+            samples.append(time.perf_counter() - started)
+        results.append(summary('select', samples))
+        samples = []
+        for _ in range(ops):
+            participant_id = rng.randrange(1, size + 1)
+            started = time.perf_counter()
+            await db.update(PARTICIPANTS, prize='bench', id=participant_id)
+            samples.append(time.perf_counter() - started)
+        results.append(summary('update', samples))
+        samples = []
+        for _ in range(ops):
+            started = time.perf_counter()
+            await db.count_list(PARTICIPANTS)
+            samples.append(time.perf_counter() - started)
+        results.append(summary('count', samples))
+        return results
+    finally:
+        await db.close()
+
+
+async def bench_pipeline(storage: Storage, joins: int, users: int, lotteries: int, seed: int) -> dict:
+    # 模拟参与处理流程：JoinGuard 拦截 -> 写入参与人员 -> 记录事件，每批 100 个并发参与
+    rng = random.Random(seed)
+    await storage.open()
+    guard = JoinGuard(rate=1000, burst=1000)
+    journal = EventJournal(storage).start()
+    try:
+        lottery_ids = [await storage.add_lottery(chat_id=i, message_id=1, title='bench', status=1, drawn_people=0,
+                                                 winner_people='10', password='bench', same_prize=1, prize='bench',
+                                                 creator_id=1) for i in range(lotteries)]
+        samples = []
+        accepted = 0
+
+        async def join(lottery_id: int, user_id: int):
+            nonlocal accepted
+            started = time.perf_counter()
+            if guard.allow(lottery_id, user_id):
+                try:
+                    await storage.add_participant(user_id, f'U{user_id:x}', lottery_id)
+                    journal.record('joined', lottery_id, 0, dict(users=[[user_id, f'U{user_id:x}']]))
+                    accepted += 1
+                except sqlite3.IntegrityError:
+                    pass
+            samples.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for index in range(0, joins, 100):
+            await asyncio.gather(*(join(rng.choice(lottery_ids), rng.randrange(users))
+                                   for _ in range(min(100, joins - index))))
+        await journal.stop()
+        elapsed = time.perf_counter() - started
+        result = summary('join', samples)
+        result.update(ops=joins / elapsed, accepted=accepted, stall=0.0)
+        if isinstance(storage, MemoryStorage):
+            result['stall'] = await measure_stall(storage.snapshot())
+        return result
+    finally:
+        await storage.close()
+
+
+async def measure_stall(coro) -> float:
+    # 快照期间事件循环最长无法调度的时间(毫秒)
+    stall = 0.0
+    done = False
+
+    async def probe():
+        nonlocal stall
+        while not done:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stall = max(stall, time.perf_counter() - started - 0.001)
+
+    task = asyncio.create_task(probe())
+    await asyncio.sleep(0)
+    await coro
+    done = True
+    await task
+    return stall * 1e3
+
+
+def run_pipeline(workdir: str, joins: int, seed: int):
+    print(f'{"engine":<8} {"joins/s":>9} {"p50 us":>8} {"p99 us":>8} {"accepted":>9} {"stall ms":>9}')
+    engines = [
+        ('sqlite', SqliteStorage(os.path.join(workdir, 'pipeline.db'))),
+        ('memory', MemoryStorage(os.path.join(workdir, 'pipeline.json'), 0)),
+    ]
+    for name, storage in engines:
+        result = asyncio.run(bench_pipeline(storage, joins, joins // 2, 20, seed))
+        print(f'{name:<8} {result["ops"]:>9.0f} {result["p50"]:>8.1f} {result["p99"]:>8.1f} '
+              f'{result["accepted"]:>9} {result["stall"]:>9.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare dbLite and aioDbLite on the participants table')
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='comma separated table sizes')
+    parser.add_argument('--ops', type=int, default=2000, help='operations per single-row benchmark')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--pipeline', type=int, default=0, metavar='JOINS',
+                        help='benchmark the join pipeline on both storage engines instead')
+    args = parser.parse_args()
+    if args.pipeline:
+        with tempfile.TemporaryDirectory() as workdir:
+            run_pipeline(workdir, args.pipeline, args.seed)
+        return
+    sizes = [int(size) for size in args.sizes.split(',')]
+    print(f'{"rows":>9} {"op":<7} {"sync ops/s":>11} {"p50 us":>8} {"p99 us":>8} '
+          f'{"async ops/s":>11} {"p50 us":>8} {"p99 us":>8} {"ratio":>6}')
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            sync_results = bench_sync(os.path.join(workdir, f'sync_{size}.db'), size, args.ops, args.seed)
+            async_results = asyncio.run(bench_async(os.path.join(workdir, f'async_{size}.db'), size, args.ops,
+                                                    args.seed))
+            for s, a in zip(sync_results, async_results):
+                ratio = s['ops'] / a['ops'] if a['ops'] else 0
+                print(f'{size:>9} {s["op"]:<7} {s["ops"]:>11.0f} {s["p50"]:>8.1f} {s["p99"]:>8.1f} '
+                      f'{a["ops"]:>11.0f} {a["p50"]:>8.1f} {a["p99"]:>8.1f} {ratio:>5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,19 @@
+import asyncio
 import sqlite3
+from contextlib import asynccontextmanager
+
 import aiosqlite
 from async_class import AsyncObject
 
 
 class dbLite(object):
-    def __init__(self, db_name):
+    def __init__(self, db_name, readonly=False):
+        if readonly:
+            # 只读打开不修改日志和锁模式，用于读取备份文件
+            self.conn = sqlite3.connect(f'file:{db_name}?mode=ro', uri=True, isolation_level=None,
+                                        check_same_thread=False)
+            self.cursor = self.conn.cursor()
+            return
         self.conn = sqlite3.connect(db_name, isolation_level=None, check_same_thread=False)
         self.cursor = self.conn.cursor()
         self.cursor.execute('PRAGMA journal_mode = WAL;')
@@ -32,10 +41,23 @@ class dbLite(object):
         self.conn.commit()
 
     def add_list(self, target, source, col, **kwargs):
-        condition = ' AND '.join("{} IN ({})".format(k, ','.join(f'"{x}"' for x in kwargs[k])) for k in kwargs)
+        condition = ' AND '.join("{} IN ({})".format(k, ', '.join('?' * len(kwargs[k]))) for k in kwargs)
         query = f"INSERT INTO {target} SELECT {col} FROM {source} WHERE {condition}"
-        self.cursor.execute(query)
+        self.cursor.execute(query, tuple(x for k in kwargs for x in kwargs[k]))
+        self.conn.commit()
+
+    def add_many(self, table_name, columns, rows, ignore=False):
+        col = ', '.join(columns)
+        val = ', '.join('?' * len(columns))
+        query = f"INSERT {'OR IGNORE ' if ignore else ''}INTO {table_name} ({col}) VALUES ({val})"
+        self.cursor.execute('BEGIN')
+        try:
+            self.cursor.executemany(query, rows)
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
         self.conn.commit()
+        return self.cursor.rowcount
 
     def remove(self, table_name, **kwargs):
         condition = ' AND '.join(f"{k} = ?" for k, _ in kwargs.items())
@@ -71,6 +93,19 @@ class dbLite(object):
         data = self.cursor.execute(query)
         return data.fetchall()
 
+    def iterate(self, table_name, data, chunk_size=1000, **kwargs):
+        condition = ' AND '.join(f"{k} = ?" for k, _ in kwargs.items()) or '1'
+        query = f"SELECT {data} FROM {table_name} WHERE {condition} ORDER BY rowid"
+        cursor = self.conn.execute(query, tuple(list(kwargs.values())))
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
     def count_list(self, target):
         return self.cursor.execute(f"SELECT COUNT(1) FROM {target}").fetchone()[0]
 
@@ -81,7 +116,7 @@ class dbLite(object):
     def __enter__(self):
         return self
 
-    def __exit__(self):
+    def __exit__(self, *args):
         self.close()
 
 
@@ -89,75 +124,118 @@ class aioDbLite(AsyncObject):
     async def __ainit__(self, db_name):
         self.conn = await aiosqlite.connect(db_name, isolation_level=None, check_same_thread=False)
         self.cursor = await self.conn.cursor()
+        # 所有协程共用一个连接和游标，执行与读取结果、事务都需要在锁内完成，避免互相穿插
+        self.lock = asyncio.Lock()
         await self.cursor.execute('PRAGMA journal_mode = WAL;')
         await self.cursor.execute('PRAGMA synchronous = OFF;')
         await self.cursor.execute('PRAGMA cache_size = 1000000;')
         await self.cursor.execute('PRAGMA locking_mode = EXCLUSIVE;')
         await self.cursor.execute('PRAGMA temp_store = MEMORY;')
 
+    async def execute(self, query, params=()):
+        async with self.lock:
+            await self.cursor.execute(query, params)
+            await self.conn.commit()
+            return self.cursor.rowcount
+
+    async def fetchone(self, query, params=()):
+        async with self.lock:
+            await self.cursor.execute(query, params)
+            return await self.cursor.fetchone()
+
+    async def fetchall(self, query, params=()):
+        async with self.lock:
+            await self.cursor.execute(query, params)
+            return await self.cursor.fetchall()
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self.lock:
+            await self.cursor.execute('BEGIN')
+            try:
+                yield self.cursor
+            except BaseException:
+                await self.conn.rollback()
+                raise
+            await self.conn.commit()
+
     async def create(self, table_name, **kwargs):
         data = ', '.join(f"{k} {v}" for k, v in kwargs.items())
         query = f"CREATE TABLE IF NOT EXISTS {table_name} ({data})"
-        await self.cursor.execute(query)
-        await self.conn.commit()
+        await self.execute(query)
 
     async def drop(self, table_name):
         query = f"DROP TABLE IF EXISTS {table_name}"
-        await self.cursor.execute(query)
-        await self.conn.commit()
+        await self.execute(query)
 
     async def add(self, table_name, **kwargs):
         col = ', '.join(list(kwargs.keys()))
         val = ', '.join('?' * len(list(kwargs.values())))
         query = f"INSERT INTO {table_name} ({col}) VALUES ({val})"
-        await self.cursor.execute(query, tuple(list(kwargs.values())))
-        await self.conn.commit()
+        async with self.lock:
+            await self.cursor.execute(query, tuple(list(kwargs.values())))
+            await self.conn.commit()
+            return self.cursor.lastrowid
 
     async def add_list(self, target, source, col, **kwargs):
-        condition = ' AND '.join("{} IN ({})".format(k, ','.join(f'"{x}"' for x in kwargs[k])) for k in kwargs)
+        condition = ' AND '.join("{} IN ({})".format(k, ', '.join('?' * len(kwargs[k]))) for k in kwargs)
         query = f"INSERT INTO {target} SELECT {col} FROM {source} WHERE {condition}"
-        await self.cursor.execute(query)
-        await self.conn.commit()
+        await self.execute(query, tuple(x for k in kwargs for x in kwargs[k]))
+
+    async def add_many(self, table_name, columns, rows, ignore=False):
+        col = ', '.join(columns)
+        val = ', '.join('?' * len(columns))
+        query = f"INSERT {'OR IGNORE ' if ignore else ''}INTO {table_name} ({col}) VALUES ({val})"
+        async with self.transaction() as cursor:
+            await cursor.executemany(query, rows)
+            return cursor.rowcount
 
     async def remove(self, table_name, **kwargs):
         condition = ' AND '.join(f"{k} = ?" for k, _ in kwargs.items())
         query = f"DELETE FROM {table_name} WHERE {condition}"
-        await self.cursor.execute(query, tuple(list(kwargs.values())))
-        await self.conn.commit()
+        await self.execute(query, tuple(list(kwargs.values())))
 
     async def select(self, table_name, data, **kwargs):
         condition = ' AND '.join(f"{k} = ?" for k, _ in kwargs.items())
         query = f"SELECT {data} FROM {table_name} WHERE {condition}"
-        data = await self.cursor.execute(query, tuple(list(kwargs.values())))
-        return await data.fetchall()
+        return await self.fetchall(query, tuple(list(kwargs.values())))
 
     async def random(self, table_name, data):
         query = f"SELECT {data} FROM {table_name} ORDER BY RANDOM() LIMIT 1"
-        data = await self.cursor.execute(query)
-        return list(map(' '.join, await data.fetchall()))[0]
+        return list(map(' '.join, await self.fetchall(query)))[0]
 
     async def update(self, table_name, **kwargs):
         data_set = ', '.join(f"{k} = ?" for k in list(kwargs.keys())[:-1])
         condition = f"{list(kwargs.keys())[-1]} = ?"
         query = f"UPDATE {table_name} SET {data_set} WHERE {condition}"
-        await self.cursor.execute(query, tuple(list(kwargs.values())))
-        await self.conn.commit()
+        return await self.execute(query, tuple(list(kwargs.values())))
 
     async def update_all(self, target, source, col):
         query = f"INSERT INTO {target} SELECT {col} FROM {source}"
-        await self.cursor.execute(query)
-        await self.conn.commit()
+        await self.execute(query)
 
     async def data(self, table_name):
         query = f"SELECT * FROM {table_name}"
-        data = await self.cursor.execute(query)
-        return await data.fetchall()
+        return await self.fetchall(query)
+
+    async def iterate(self, table_name, data, chunk_size=1000, **kwargs):
+        condition = ' AND '.join(f"{k} = ?" for k, _ in kwargs.items()) or '1'
+        query = f"SELECT {data} FROM {table_name} WHERE {condition} ORDER BY rowid"
+        # 使用独立游标且不持有锁，避免调用方在两批之间写入时死锁
+        async with self.conn.execute(query, tuple(list(kwargs.values()))) as cursor:
+            while True:
+                rows = await cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
 
     async def count_list(self, target):
-        return await self.cursor.execute(f"SELECT COUNT(1) FROM {target}").fetchone()[0]
+        return (await self.fetchone(f"SELECT COUNT(1) FROM {target}"))[0]
 
     async def close(self):
         try:
+            # 先关闭共享游标，未释放的语句会让连接延迟关闭，数据库一直处于锁定状态
+            await self.cursor.close()
             await self.conn.close()
         except ValueError:
             pass
@@ -165,5 +243,5 @@ class aioDbLite(AsyncObject):
     async def __aenter__(self):
         return self
 
-    async def __aexit__(self):
+    async def __aexit__(self, *args):
         await self.close()
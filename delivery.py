@@ -0,0 +1,124 @@
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+from pyrogram.errors import FloodWait, RPCError, UserIsBlocked, PeerIdInvalid, InputUserDeactivated, UserDeactivated
+
+from ratelimit import TokenBucket
+from storage import Storage
+from utils import DeliveryType, load_pending_deliveries, add_deliveries, set_delivery, prize2message
+
+# 用户未启动机器人、已拉黑或已注销时无法私聊，不再重试
+PERMANENT_ERRORS = (UserIsBlocked, PeerIdInvalid, InputUserDeactivated, UserDeactivated)
+
+
+# 开奖后主动私聊发送奖品，发送状态记录在 deliveries 表中，重启后继续发送
+class PrizeDelivery(object):
+    def __init__(
+            self,
+            storage: Storage,
+            send: Callable[[int, str], Awaitable],
+            concurrency: int = 8,
+            rate: float = 20,
+            max_attempts: int = 5,
+            backoff: int = 5
+    ):
+        self.storage = storage
+        self.send = send
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        # 所有 worker 共用一个令牌桶，控制整体发送速度，每秒少于一条时容量至少为 1
+        self.bucket = TokenBucket(rate, max(1, rate))
+        # 遇到限流时所有 worker 暂停到该时间(monotonic)
+        self.paused_until = 0
+        self.queue: asyncio.Queue[DeliveryType] = asyncio.Queue()
+        self.workers: list[asyncio.Task] = []
+        # 已在队列中或等待重试的记录，避免重复发送
+        self.queued: set[int] = set()
+        self.counters = dict(sent=0, failed=0, retried=0)
+
+    async def start(self):
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        pending = await load_pending_deliveries(self.storage)
+        for delivery in pending:
+            self._put(delivery)
+        return len(pending)
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def enqueue_lottery(self, lottery_id: int):
+        await add_deliveries(self.storage, lottery_id)
+        for delivery in await load_pending_deliveries(self.storage, lottery_id):
+            self._put(delivery)
+
+    def _put(self, delivery: DeliveryType):
+        if delivery['id'] in self.queued:
+            return
+        self.queued.add(delivery['id'])
+        self.queue.put_nowait(delivery)
+
+    async def _acquire(self):
+        while True:
+            paused = self.paused_until - time.monotonic()
+            if paused > 0:
+                await asyncio.sleep(paused)
+                continue
+            if self.bucket.consume():
+                return
+            await asyncio.sleep(1 / self.bucket.rate)
+
+    def _retry_later(self, delivery: DeliveryType, delay: float):
+        asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, delivery)
+
+    async def _worker(self):
+        while True:
+            delivery = await self.queue.get()
+            try:
+                await self._deliver(delivery)
+            except Exception as e:
+                self.queued.discard(delivery['id'])
+                print(f'[-] Prize delivery {delivery["id"]} failed: {e}')
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, delivery: DeliveryType):
+        delay = delivery['next_at'] - time.time()
+        if delay > 0:
+            self._retry_later(delivery, delay)
+            return
+        await self._acquire()
+        try:
+            await self.send(delivery['user_id'], prize2message(delivery['title'], delivery['prize']))
+        except FloodWait as e:
+            # 限流不计入重试次数，其它 worker 继续发送只会延长等待时间，一起暂停
+            self.paused_until = max(self.paused_until, time.monotonic() + e.value)
+            self._retry_later(delivery, e.value)
+            return
+        except PERMANENT_ERRORS as e:
+            self.queued.discard(delivery['id'])
+            self.counters['failed'] += 1
+            await set_delivery(self.storage, delivery['id'], status=2, error=e.ID or type(e).__name__)
+            return
+        except (RPCError, OSError) as e:
+            attempts = delivery['attempts'] + 1
+            if attempts >= self.max_attempts:
+                self.queued.discard(delivery['id'])
+                self.counters['failed'] += 1
+                await set_delivery(self.storage, delivery['id'], status=2, attempts=attempts, error=str(e))
+                return
+            delay = self.backoff * 2 ** attempts
+            delivery['attempts'] = attempts
+            delivery['next_at'] = int(time.time() + delay)
+            self.counters['retried'] += 1
+            await set_delivery(self.storage, delivery['id'], attempts=attempts, next_at=delivery['next_at'],
+                               error=str(e))
+            self._retry_later(delivery, delay)
+            return
+        self.queued.discard(delivery['id'])
+        self.counters['sent'] += 1
+        await set_delivery(self.storage, delivery['id'], status=1, attempts=delivery['attempts'] + 1)
@@ -0,0 +1,62 @@
+import asyncio
+import json
+import time
+from typing import Optional
+
+from storage import Storage
+
+EVENT_TYPES = ['created', 'configured', 'started', 'joined', 'paused', 'drawn', 'cancelled', 'prize_claimed']
+
+
+def lottery_snapshot(lottery: dict) -> dict:
+    snapshot = dict(lottery)
+    # 奖品各不相同时 make_lottery 会拆分为列表，恢复为数据表中的格式
+    if isinstance(snapshot.get('prize'), list):
+        snapshot['prize'] = '\n'.join(snapshot['prize'])
+    return snapshot
+
+
+# 抽奖生命周期的追加式事件日志，事件先写入内存缓冲区，再按批次写入存储
+class EventJournal(object):
+    def __init__(self, storage: Storage, batch_size: int = 200, flush_interval: float = 1):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer: list[tuple] = []
+        self._lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        return self
+
+    async def stop(self):
+        self._flush_task and self._flush_task.cancel()
+        await self.flush()
+
+    def record(self, event: str, lottery_id: int, chat_id: int, payload: dict = None):
+        assert event in EVENT_TYPES, f'Unknown event: {event}'
+        self.buffer.append((lottery_id, chat_id, event, json.dumps(payload or {}, ensure_ascii=False),
+                            int(time.time())))
+        if len(self.buffer) >= self.batch_size:
+            asyncio.create_task(self.flush())
+
+    async def flush(self):
+        async with self._lock:
+            if not self.buffer:
+                return
+            rows, self.buffer = self.buffer, []
+            try:
+                await self.storage.add_events(rows)
+            except Exception:
+                # 写入失败时放回缓冲区，下次继续写入
+                self.buffer = rows + self.buffer
+                raise
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f'[-] Flush event journal failed: {e}')
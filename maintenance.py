@@ -0,0 +1,134 @@
+import argparse
+import json
+import sqlite3
+import time
+
+from dblite import dbLite
+from storage import LOTTERIES, PARTICIPANTS, DELIVERIES, EVENTS, LOTTERY_COLUMNS, PARTICIPANT_COLUMNS, \
+    DELIVERY_COLUMNS, INSERT_UNIQUE_PARTICIPANT, ARCHIVE_SUFFIX
+from utils import read_participant_rows
+
+# 离线维护任务，使用同步的 dbLite 在独立进程中运行，不占用机器人的事件循环和数据库连接
+# 数据库以独占模式打开，运行前需要先停止机器人
+
+# 每个事务归档的抽奖数量
+ARCHIVE_BATCH = 100
+
+
+def reindex(db: dbLite, vacuum: bool = False):
+    db.cursor.execute('REINDEX')
+    db.cursor.execute('ANALYZE')
+    if vacuum:
+        db.cursor.execute('VACUUM')
+
+
+def archive(db: dbLite, keep: int = 3) -> tuple[int, int]:
+    # 每个群组保留最近 keep 个已结束的抽奖，其余连同参与人员和发送记录移动到归档表
+    # 仍有待发送奖品的抽奖不归档，已归档的中奖者通过 get_prize_by_user 查询归档表领取奖品
+    db.create(LOTTERIES + ARCHIVE_SUFFIX, **LOTTERY_COLUMNS)
+    db.create(PARTICIPANTS + ARCHIVE_SUFFIX, **PARTICIPANT_COLUMNS)
+    db.create(DELIVERIES + ARCHIVE_SUFFIX, **DELIVERY_COLUMNS)
+    db.cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_participants_archive_user ON {PARTICIPANTS}{ARCHIVE_SUFFIX} '
+                      f'(user_id);')
+    rows = db.cursor.execute(
+        f'SELECT id FROM {LOTTERIES} l WHERE status = 2 '
+        f'AND (SELECT COUNT(1) FROM {LOTTERIES} n WHERE n.chat_id = l.chat_id AND n.status = 2 AND n.id > l.id) >= ? '
+        f'AND NOT EXISTS (SELECT 1 FROM {DELIVERIES} d WHERE d.lottery_id = l.id AND d.status = 0) '
+        f'ORDER BY id', (keep,)).fetchall()
+    lottery_ids = [lottery_id for lottery_id, in rows]
+    participants = 0
+    for index in range(0, len(lottery_ids), ARCHIVE_BATCH):
+        batch = lottery_ids[index: index + ARCHIVE_BATCH]
+        condition = ', '.join('?' * len(batch))
+        db.cursor.execute('BEGIN')
+        try:
+            for table, column in [(LOTTERIES, 'id'), (PARTICIPANTS, 'lottery_id'), (DELIVERIES, 'lottery_id')]:
+                db.cursor.execute(f'INSERT OR REPLACE INTO {table}{ARCHIVE_SUFFIX} '
+                                  f'SELECT * FROM {table} WHERE {column} IN ({condition})', batch)
+                db.cursor.execute(f'DELETE FROM {table} WHERE {column} IN ({condition})', batch)
+                if table == PARTICIPANTS:
+                    participants += db.cursor.rowcount
+        except sqlite3.Error:
+            db.conn.rollback()
+            raise
+        db.conn.commit()
+    return len(lottery_ids), participants
+
+
+def import_participants(db: dbLite, lottery_id: int, path: str, chunk_size: int = 10000) -> tuple[int, int]:
+    lottery = db.select(LOTTERIES, 'chat_id', id=lottery_id)
+    if not lottery:
+        raise ValueError(f'Lottery {lottery_id} not found')
+    chat_id = lottery[0][0]
+    total = inserted = 0
+    chunk = []
+
+    def flush():
+        nonlocal inserted
+        # 已参与的用户按 user_id 忽略，只为实际写入的用户写入事件日志，以便 replay 重建
+        # 同步连接逐行执行的开销很小，可以直接按 rowcount 判断是否写入
+        users = []
+        db.cursor.execute('BEGIN')
+        try:
+            for user_id, user_name in chunk:
+                db.cursor.execute(INSERT_UNIQUE_PARTICIPANT, (user_id, user_name, lottery_id, user_id, lottery_id))
+                db.cursor.rowcount and users.append([user_id, user_name])
+            if users:
+                db.cursor.execute(f'INSERT INTO {EVENTS} (lottery_id, chat_id, type, payload, created_at) '
+                                  f'VALUES (?, ?, ?, ?, ?)', (lottery_id, chat_id, 'joined',
+                                                              json.dumps(dict(users=users), ensure_ascii=False),
+                                                              int(time.time())))
+        except sqlite3.Error:
+            db.conn.rollback()
+            raise
+        db.conn.commit()
+        inserted += len(users)
+        chunk.clear()
+        print(f'[+] Read {total}, imported {inserted}')
+
+    for user_id, user_name in read_participant_rows(path):
+        chunk.append((user_id, user_name))
+        total += 1
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+    return total, inserted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline maintenance for the lottery database (stop the bot first)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    reindex_parser = subparsers.add_parser('reindex', help='rebuild indexes and refresh query planner statistics')
+    reindex_parser.add_argument('db')
+    reindex_parser.add_argument('--vacuum', action='store_true', help='also compact the database file')
+    archive_parser = subparsers.add_parser('archive', help='move old finished lotteries into *_archive tables')
+    archive_parser.add_argument('db')
+    archive_parser.add_argument('--keep', type=int, default=3, help='finished lotteries to keep per group')
+    import_parser = subparsers.add_parser('import', help='bulk import participants from a CSV or JSONL file')
+    import_parser.add_argument('db')
+    import_parser.add_argument('lottery_id', type=int)
+    import_parser.add_argument('path')
+    import_parser.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args()
+    started = time.perf_counter()
+    try:
+        db = dbLite(args.db)
+    except sqlite3.OperationalError as e:
+        print(f'[-] Open {args.db} failed: {e}, is the bot still running?')
+        raise SystemExit(1)
+    with db:
+        if args.command == 'reindex':
+            reindex(db, args.vacuum)
+            print(f'[+] Reindexed {args.db}')
+        elif args.command == 'archive':
+            lotteries, participants = archive(db, args.keep)
+            print(f'[+] Archived {lotteries} lotteries and {participants} participants')
+        else:
+            total, inserted = import_participants(db, args.lottery_id, args.path, args.chunk_size)
+            print(f'[+] Imported {inserted} of {total} participants into lottery {args.lottery_id}')
+    print(f'[+] Done in {time.perf_counter() - started:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
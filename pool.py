@@ -0,0 +1,103 @@
+import asyncio
+import bisect
+import hashlib
+from typing import Iterable
+
+from pyrogram import Client
+from pyrogram.enums import ChatMemberStatus
+from pyrogram.errors import RPCError, UserIsBlocked, PeerIdInvalid, InputUserDeactivated
+
+
+def hash32(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[0: 4], 'big')
+
+
+def bot_id(bot_token: str) -> str:
+    return str(bot_token).split(':')[0]
+
+
+# 多个机器人账号组成的客户端池，群组按 chat_id 一致性哈希分配给机器人，
+# 优先选择哈希顺序中第一个在群里是管理员的机器人
+class ClientPool(object):
+    def __init__(self, clients: list[Client], replicas: int = 64):
+        self.clients = clients
+        self.ring: list[tuple[int, int]] = []
+        for index, client in enumerate(clients):
+            # 使用机器人ID作为节点名，增减 token 时只有少量群组会重新分配
+            node = bot_id(client.bot_token)
+            self.ring.extend((hash32(f'{node}#{i}'), index) for i in range(replicas))
+        self.ring.sort()
+        self.owners: dict[int, Client] = dict()
+        self._resolving: dict[int, asyncio.Task] = dict()
+
+    @property
+    def primary(self) -> Client:
+        return self.clients[0]
+
+    def preference(self, key: int) -> list[Client]:
+        if len(self.clients) == 1:
+            return self.clients
+        start = bisect.bisect(self.ring, (hash32(str(key)), -1))
+        indexes = []
+        for i in range(len(self.ring)):
+            index = self.ring[(start + i) % len(self.ring)][1]
+            if index not in indexes:
+                indexes.append(index)
+                if len(indexes) == len(self.clients):
+                    break
+        return [self.clients[index] for index in indexes]
+
+    def for_chat(self, chat_id: int) -> Client:
+        return self.owners.get(chat_id) or self.preference(chat_id)[0]
+
+    async def resolve(self, chat_id: int) -> Client:
+        if len(self.clients) == 1 or chat_id in self.owners:
+            return self.for_chat(chat_id)
+        task = self._resolving.get(chat_id)
+        if task is None:
+            task = self._resolving[chat_id] = asyncio.create_task(self._resolve(chat_id))
+            task.add_done_callback(lambda _: self._resolving.pop(chat_id, None))
+        return await task
+
+    async def resolve_all(self, chat_ids: Iterable[int], concurrency: int = 16):
+        # 启动恢复时并发确定各群组的机器人，避免逐个等待 get_chat_member
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def resolve(chat_id: int):
+            async with semaphore:
+                await self.resolve(chat_id)
+
+        await asyncio.gather(*(resolve(chat_id) for chat_id in set(chat_ids)))
+
+    async def _resolve(self, chat_id: int) -> Client:
+        candidates = self.preference(chat_id)
+        owner = candidates[0]
+        for client in candidates:
+            try:
+                member = await client.get_chat_member(chat_id=chat_id, user_id=client.me.id)
+            except RPCError:
+                continue
+            if member.status in [ChatMemberStatus.OWNER, ChatMemberStatus.ADMINISTRATOR]:
+                owner = client
+                break
+        self.owners[chat_id] = owner
+        return owner
+
+    def forget(self, chat_id: int):
+        self.owners.pop(chat_id, None)
+
+    async def send_private(self, user_id: int, text: str):
+        # 私聊只能由用户启动过的机器人发送，按用户ID分散到各个机器人，失败时依次尝试其它机器人
+        candidates = self.preference(user_id)
+        for client in candidates[0: -1]:
+            try:
+                return await client.send_message(user_id, text)
+            except (UserIsBlocked, PeerIdInvalid, InputUserDeactivated):
+                continue
+        return await candidates[-1].send_message(user_id, text)
+
+    async def start(self):
+        await asyncio.gather(*(client.start() for client in self.clients))
+
+    async def stop(self):
+        await asyncio.gather(*(client.stop() for client in self.clients))
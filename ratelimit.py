@@ -0,0 +1,87 @@
+import time
+
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float = None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now: float = None, tokens: float = 1) -> bool:
+        self.refill(time.monotonic() if now is None else now)
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+# 在写数据库和调用 Telegram 之前拦截重复参与及刷屏参与
+class JoinGuard(object):
+    def __init__(self, rate: float = 0.1, burst: float = 3, max_buckets: int = 100000):
+        # 每个用户每秒补充 rate 个令牌，最多累计 burst 个
+        self.rate = rate
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self.seen: dict[int, set[int]] = dict()
+        self.buckets: dict[int, TokenBucket] = dict()
+        # 每轮抽奖单独计数
+        self.counters: dict[int, dict[str, int]] = dict()
+
+    def load(self, lottery_id: int, user_ids):
+        self.seen[lottery_id] = set(user_ids)
+
+    def forget(self, lottery_id: int):
+        self.seen.pop(lottery_id, None)
+
+    def add(self, lottery_id: int, user_id: int):
+        self.seen.setdefault(lottery_id, set()).add(user_id)
+
+    def discard(self, lottery_id: int, user_id: int):
+        self.seen.get(lottery_id, set()).discard(user_id)
+
+    def _counters(self, lottery_id: int) -> dict[str, int]:
+        counters = self.counters.get(lottery_id)
+        if counters is None:
+            counters = self.counters[lottery_id] = dict(accepted=0, duplicate=0, flood=0)
+        return counters
+
+    def allow(self, lottery_id: int, user_id: int) -> bool:
+        seen = self.seen.setdefault(lottery_id, set())
+        counters = self._counters(lottery_id)
+        if user_id in seen:
+            counters['duplicate'] += 1
+            return False
+        now = time.monotonic()
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self._prune(now)
+            bucket = self.buckets[user_id] = TokenBucket(self.rate, self.burst, now)
+        if not bucket.consume(now):
+            counters['flood'] += 1
+            return False
+        # 先记录，避免同一用户的并发消息重复进入处理流程，写入失败时需调用 discard
+        seen.add(user_id)
+        counters['accepted'] += 1
+        return True
+
+    def _prune(self, now: float):
+        # 令牌已补满的用户与新用户等价，可以直接丢弃
+        for user_id, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self.buckets[user_id]
+        if len(self.buckets) >= self.max_buckets:
+            self.buckets.clear()
+
+    def stats(self, lottery_id: int) -> dict[str, int]:
+        stats = dict(self.counters.get(lottery_id) or dict(accepted=0, duplicate=0, flood=0))
+        stats['participants'] = len(self.seen.get(lottery_id, ()))
+        return stats
@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+from collections import Counter
+
+from dblite import dbLite
+from storage import LOTTERIES, PARTICIPANTS, EVENTS, LOTTERY_COLUMNS, PARTICIPANT_COLUMNS, INSERT_UNIQUE_PARTICIPANT
+
+# 每处理多少条事件提交一次
+COMMIT_EVERY = 10000
+
+# 源数据库只读打开，机器人运行时主库被独占，请读取 db/lotteries.backup.db 备份
+
+
+def iter_events(db: dbLite, chunk_size: int = 5000):
+    for rows in db.iterate(EVENTS, 'lottery_id, chat_id, type, payload, created_at', chunk_size):
+        for lottery_id, chat_id, _type, payload, created_at in rows:
+            yield lottery_id, chat_id, _type, json.loads(payload or '{}'), created_at
+
+
+def stats(source: str) -> dict:
+    db = dbLite(source, readonly=True)
+    events = Counter()
+    joined = winners = 0
+    # 每次 /prize 都会记录 prize_claimed，按 (抽奖, 用户) 去重统计领奖人数
+    claims = set()
+    first_at = last_at = None
+    try:
+        for lottery_id, chat_id, _type, payload, created_at in iter_events(db):
+            events[_type] += 1
+            first_at = first_at or created_at
+            last_at = created_at
+            if _type == 'joined':
+                joined += len(payload.get('users', []))
+            elif _type == 'drawn':
+                winners += len(payload.get('winners', []))
+            elif _type == 'prize_claimed':
+                claims.add((lottery_id, payload.get('user_id')))
+    finally:
+        db.close()
+    return dict(
+        events=dict(events),
+        lotteries=events['created'],
+        drawn=events['drawn'],
+        cancelled=events['cancelled'],
+        joined=joined,
+        winners=winners,
+        prize_claimed=len(claims),
+        first_at=first_at,
+        last_at=last_at,
+    )
+
+
+def rebuild(source: str, target: str) -> int:
+    if os.path.exists(target):
+        raise FileExistsError(target)
+    db = dbLite(source, readonly=True)
+    out = dbLite(target)
+    out.create(LOTTERIES, **LOTTERY_COLUMNS)
+    out.create(PARTICIPANTS, **PARTICIPANT_COLUMNS)
+    out.cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS idx_unique_users_lottery ON {PARTICIPANTS} '
+                       f'(user_id, user_name, lottery_id);')
+    out.cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_participants_lottery ON {PARTICIPANTS} (lottery_id);')
+    columns = list(LOTTERY_COLUMNS.keys())
+    insert_lottery = f'INSERT INTO {LOTTERIES} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+    cursor = out.cursor
+    count = 0
+    cursor.execute('BEGIN')
+    try:
+        for lottery_id, chat_id, _type, payload, _ in iter_events(db):
+            if _type == 'created':
+                cursor.execute(insert_lottery, tuple(payload.get(k) for k in columns))
+            elif _type == 'configured':
+                for k, v in payload.items():
+                    if k in columns and k != 'id':
+                        cursor.execute(f'UPDATE {LOTTERIES} SET {k} = ? WHERE id = ?', (v, lottery_id))
+            elif _type in ['started', 'paused']:
+                cursor.execute(f'UPDATE {LOTTERIES} SET status = ? WHERE id = ?',
+                               (1 if _type == 'started' else 0, lottery_id))
+            elif _type == 'joined':
+                cursor.executemany(INSERT_UNIQUE_PARTICIPANT, [(user_id, user_name, lottery_id, user_id, lottery_id)
+                                                               for user_id, user_name in payload['users']])
+            elif _type == 'drawn':
+                cursor.execute(f'UPDATE {PARTICIPANTS} SET prize = NULL WHERE lottery_id = ?', (lottery_id,))
+                cursor.executemany(f'UPDATE {PARTICIPANTS} SET prize = ? '
+                                   f'WHERE lottery_id = ? AND user_id = ? AND user_name = ?',
+                                   [(prize, lottery_id, user_id, user_name)
+                                    for user_id, user_name, prize in payload['winners']])
+                cursor.execute(f'UPDATE {LOTTERIES} SET status = 2 WHERE id = ?', (lottery_id,))
+            elif _type == 'cancelled':
+                # 与线上数据一致，取消的抽奖不保留在 lotteries 表中
+                cursor.execute(f'DELETE FROM {LOTTERIES} WHERE id = ?', (lottery_id,))
+            count += 1
+            if count % COMMIT_EVERY == 0:
+                out.conn.commit()
+                cursor.execute('BEGIN')
+        out.conn.commit()
+    finally:
+        db.close()
+        out.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay the lottery event journal')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    stats_parser = subparsers.add_parser('stats', help='compute statistics from the event journal')
+    stats_parser.add_argument('source', help='database containing the events table')
+    rebuild_parser = subparsers.add_parser('rebuild', help='rebuild lotteries/participants into a new database')
+    rebuild_parser.add_argument('source', help='database containing the events table')
+    rebuild_parser.add_argument('target', help='new database to create')
+    args = parser.parse_args()
+    started = time.perf_counter()
+    try:
+        if args.command == 'stats':
+            print(json.dumps(stats(args.source), ensure_ascii=False, indent=2))
+        else:
+            count = rebuild(args.source, args.target)
+            print(f'[+] Replayed {count} events into {args.target}')
+    except sqlite3.OperationalError as e:
+        print(f'[-] Read {args.source} failed: {e}, read the backup (db/lotteries.backup.db) while the bot is running')
+        raise SystemExit(1)
+    print(f'[+] Done in {time.perf_counter() - started:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
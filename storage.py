@@ -0,0 +1,618 @@
+import asyncio
+import json
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Optional, Union
+
+from dblite import aioDbLite
+
+LOTTERIES = 'lotteries'
+PARTICIPANTS = 'participants'
+TEMP_MESSAGES = 'temp_messages'
+DELIVERIES = 'deliveries'
+EVENTS = 'events'
+# maintenance.py 归档已结束抽奖时使用的表名后缀
+ARCHIVE_SUFFIX = '_archive'
+
+LOTTERY_COLUMNS = dict(
+    id='INTEGER PRIMARY KEY AUTOINCREMENT',
+    chat_id='int',
+    message_id='int',
+    title='TEXT NOT NULL',
+    status='int(1)',  # 抽奖状态 0 已暂停 1 抽奖中 2 已结束 3 开奖中
+    drawn_people='int',  # 开奖人数 为 null 或者 0 时 不自动开奖
+    winner_people='varchar(255)',  # 数字或者百分比
+    password='varchar(1024)',  # 参与抽奖口令
+    same_prize='int(1)',  # 1 相同的奖品  0 每个人都不一样
+    prize='TEXT',  # 奖品
+    creator_id='int',  # 创建人ID
+)
+PARTICIPANT_COLUMNS = dict(
+    id='INTEGER PRIMARY KEY AUTOINCREMENT',
+    user_id='int',
+    user_name='varchar(1024)',
+    lottery_id='int',  # 本轮抽奖ID
+    prize='TEXT',  # 奖品
+)
+TEMP_MESSAGE_COLUMNS = dict(
+    id='INTEGER PRIMARY KEY AUTOINCREMENT',
+    chat_id='int',
+    message_id='int',
+    delete_at='int',  # 计划删除的时间戳
+)
+DELIVERY_COLUMNS = dict(
+    id='INTEGER PRIMARY KEY AUTOINCREMENT',
+    participant_id='int',  # 中奖的参与人员ID
+    lottery_id='int',
+    user_id='int',
+    status='int(1)',  # 发送状态 0 待发送 1 已发送 2 发送失败
+    attempts='int',  # 已尝试次数
+    next_at='int',  # 下次发送的时间戳
+    error='TEXT',  # 最后一次失败原因
+)
+EVENT_COLUMNS = dict(
+    id='INTEGER PRIMARY KEY AUTOINCREMENT',
+    lottery_id='int',
+    chat_id='int',
+    type='varchar(32)',  # 事件类型 created configured started joined paused drawn cancelled prize_claimed
+    payload='TEXT',  # JSON
+    created_at='int',
+)
+
+Row = Union[list, tuple]
+
+# MemoryStorage 写快照时每批编码的行数
+SNAPSHOT_CHUNK_SIZE = 2000
+
+# 同一用户在一轮抽奖中只保留一条记录，唯一索引包含 user_name，改名后仍需按 user_id 去重
+# 参数为 (user_id, user_name, lottery_id, user_id, lottery_id)
+INSERT_UNIQUE_PARTICIPANT = f'INSERT INTO `{PARTICIPANTS}` (user_id, user_name, lottery_id) SELECT ?, ?, ? ' \
+                            f'WHERE NOT EXISTS (SELECT 1 FROM `{PARTICIPANTS}` WHERE user_id = ? AND lottery_id = ?)'
+
+
+# 存储接口，除特别说明外方法返回与数据表列顺序一致的原始行，由 utils 转换为对应类型
+# 引擎缺少任何方法时在创建实例时即报错
+class Storage(ABC):
+    @abstractmethod
+    async def open(self):
+        ...
+
+    @abstractmethod
+    async def close(self):
+        ...
+
+    @abstractmethod
+    async def add_lottery(self, **kwargs) -> int:
+        ...
+
+    @abstractmethod
+    async def update_lottery(self, lottery_id: int, **kwargs):
+        ...
+
+    # 状态为 expected 之一时才修改为 status，返回是否修改成功
+    @abstractmethod
+    async def swap_lottery_status(self, lottery_id: int, status: int, expected: list) -> bool:
+        ...
+
+    @abstractmethod
+    async def remove_lottery(self, lottery_id: int):
+        ...
+
+    @abstractmethod
+    async def get_lottery(self, lottery_id: int) -> Optional[Row]:
+        ...
+
+    @abstractmethod
+    async def find_lottery(self, chat_id: int, status: list) -> Optional[Row]:
+        ...
+
+    @abstractmethod
+    async def find_lotteries(self, status: list) -> list[Row]:
+        ...
+
+    # 重复参与时抛出 sqlite3.IntegrityError
+    @abstractmethod
+    async def add_participant(self, user_id: int, user_name: str, lottery_id: int):
+        ...
+
+    # 批量写入 (user_id, user_name)，按 user_id 忽略已参与的用户，返回实际写入的行
+    @abstractmethod
+    async def add_participants(self, lottery_id: int, rows: list[tuple[int, str]]) -> list[tuple[int, str]]:
+        ...
+
+    @abstractmethod
+    async def load_participants(self, lottery_id: int) -> list[Row]:
+        ...
+
+    @abstractmethod
+    def iter_participants(self, lottery_id: int, chunk_size: int = 1000) -> AsyncIterator[list[Row]]:
+        ...
+
+    @abstractmethod
+    async def get_latest_participant(self, user_id: int) -> Optional[Row]:
+        ...
+
+    @abstractmethod
+    async def set_participant_prize(self, participant_id: int, prize: str):
+        ...
+
+    # 清空并写入整轮抽奖的中奖信息，需保证原子性
+    @abstractmethod
+    async def set_winners(self, lottery_id: int, winners: list[tuple[int, str]]):
+        ...
+
+    @abstractmethod
+    async def add_temp_message(self, chat_id: int, message_id: int, delete_at: int):
+        ...
+
+    @abstractmethod
+    async def remove_temp_message(self, chat_id: int, message_id: int):
+        ...
+
+    @abstractmethod
+    async def load_temp_messages(self) -> list[Row]:
+        ...
+
+    # 为抽奖的中奖者创建待发送记录，已存在的忽略
+    @abstractmethod
+    async def add_deliveries(self, lottery_id: int, next_at: int):
+        ...
+
+    # 返回 (id, user_id, attempts, next_at, title, prize)，只包含仍然中奖的记录
+    @abstractmethod
+    async def load_pending_deliveries(self, lottery_id: int = None) -> list[Row]:
+        ...
+
+    @abstractmethod
+    async def update_delivery(self, delivery_id: int, **kwargs):
+        ...
+
+    # 返回用户最近一次参与的 (lottery_id, title, prize)
+    @abstractmethod
+    async def get_prize_by_user(self, user_id: int) -> Optional[Row]:
+        ...
+
+    # 批量追加 (lottery_id, chat_id, type, payload, created_at)
+    @abstractmethod
+    async def add_events(self, rows: list[tuple]):
+        ...
+
+
+class SqliteStorage(Storage):
+    def __init__(self, db_name: str, backup_interval: int = 0):
+        self.db_name = db_name
+        # 数据库以独占模式打开，定时备份到 backup_path 供 replay.py 等离线工具读取
+        self.backup_path = f'{os.path.splitext(db_name)[0]}.backup.db'
+        self.backup_interval = backup_interval
+        self.aiodb: aioDbLite = None
+        self.has_archive = False
+        self._backup_task: Optional[asyncio.Task] = None
+
+    async def open(self):
+        aiodb = self.aiodb = await aioDbLite(self.db_name)
+        await aiodb.create(LOTTERIES, **LOTTERY_COLUMNS)
+        await aiodb.create(PARTICIPANTS, **PARTICIPANT_COLUMNS)
+        await aiodb.create(TEMP_MESSAGES, **TEMP_MESSAGE_COLUMNS)
+        await aiodb.create(DELIVERIES, **DELIVERY_COLUMNS)
+        await aiodb.create(EVENTS, **EVENT_COLUMNS)
+        sql = f'CREATE UNIQUE INDEX IF NOT EXISTS idx_unique_users_lottery ON {PARTICIPANTS} ' \
+              f'(user_id, user_name, lottery_id);'
+        await aiodb.execute(sql)
+        # 启动恢复时按状态扫描抽奖，按抽奖加载参与人员
+        sql = f'CREATE INDEX IF NOT EXISTS idx_lotteries_status ON {LOTTERIES} (status, chat_id);'
+        await aiodb.execute(sql)
+        sql = f'CREATE INDEX IF NOT EXISTS idx_participants_lottery ON {PARTICIPANTS} (lottery_id);'
+        await aiodb.execute(sql)
+        sql = f'CREATE UNIQUE INDEX IF NOT EXISTS idx_unique_deliveries ON {DELIVERIES} (participant_id);'
+        await aiodb.execute(sql)
+        sql = f'CREATE INDEX IF NOT EXISTS idx_deliveries_status ON {DELIVERIES} (status, lottery_id);'
+        await aiodb.execute(sql)
+        # 归档表由离线维护任务创建，运行期间不会变化
+        sql = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+        self.has_archive = (await aiodb.fetchone(sql, (PARTICIPANTS + ARCHIVE_SUFFIX,))) is not None
+        if self.backup_interval > 0:
+            self._backup_task = asyncio.create_task(self._backup_loop())
+        return self
+
+    async def close(self):
+        self._backup_task and self._backup_task.cancel()
+        self.aiodb and (await self.aiodb.close())
+
+    async def _backup_loop(self):
+        while True:
+            await asyncio.sleep(self.backup_interval)
+            try:
+                await self.backup()
+            except (sqlite3.Error, OSError) as e:
+                print(f'[-] Backup {self.backup_path} failed: {e}')
+
+    async def backup(self, path: str = None):
+        # 使用 sqlite 在线备份 API 在数据库线程中复制，写入临时文件后替换，读取方不会看到写了一半的文件
+        path = path or self.backup_path
+        temp_path = f'{path}.tmp'
+        os.path.exists(temp_path) and os.remove(temp_path)
+        target = sqlite3.connect(temp_path, check_same_thread=False)
+        try:
+            async with self.aiodb.lock:
+                await self.aiodb.conn.backup(target)
+            # 备份会复制 WAL 模式，改回默认模式以便只读打开
+            target.execute('PRAGMA journal_mode = DELETE;')
+        finally:
+            target.close()
+        os.replace(temp_path, path)
+
+    async def add_lottery(self, **kwargs) -> int:
+        return await self.aiodb.add(LOTTERIES, **kwargs)
+
+    async def update_lottery(self, lottery_id: int, **kwargs):
+        await self.aiodb.update(LOTTERIES, **kwargs, id=lottery_id)
+
+    async def swap_lottery_status(self, lottery_id: int, status: int, expected: list) -> bool:
+        placeholders = ', '.join('?' * len(expected))
+        sql = f'UPDATE `{LOTTERIES}` SET status = ? WHERE id = ? AND status IN ({placeholders})'
+        return await self.aiodb.execute(sql, (status, lottery_id, *expected)) == 1
+
+    async def remove_lottery(self, lottery_id: int):
+        await self.aiodb.remove(LOTTERIES, id=lottery_id)
+
+    async def get_lottery(self, lottery_id: int) -> Optional[Row]:
+        sql = f'SELECT * FROM `{LOTTERIES}` WHERE id = ?'
+        return await self.aiodb.fetchone(sql, (lottery_id,))
+
+    async def find_lottery(self, chat_id: int, status: list) -> Optional[Row]:
+        placeholders = ', '.join('?' * len(status))
+        sql = f'SELECT * FROM `{LOTTERIES}` WHERE chat_id = ? AND status IN ({placeholders}) ORDER BY id DESC'
+        return await self.aiodb.fetchone(sql, (chat_id, *status))
+
+    async def find_lotteries(self, status: list) -> list[Row]:
+        placeholders = ', '.join('?' * len(status))
+        sql = f'SELECT * FROM `{LOTTERIES}` WHERE status IN ({placeholders}) ORDER BY id'
+        return await self.aiodb.fetchall(sql, tuple(status))
+
+    async def add_participant(self, user_id: int, user_name: str, lottery_id: int):
+        inserted = await self.aiodb.execute(INSERT_UNIQUE_PARTICIPANT,
+                                            (user_id, user_name, lottery_id, user_id, lottery_id))
+        if inserted == 0:
+            raise sqlite3.IntegrityError('UNIQUE constraint failed: participants.user_id, participants.lottery_id')
+
+    async def add_participants(self, lottery_id: int, rows: list[tuple[int, str]]) -> list[tuple[int, str]]:
+        async with self.aiodb.transaction() as cursor:
+            # 在同一事务中查出已参与的用户，只写入新用户，调用方可以只为实际写入的行记录事件
+            existing = set()
+            user_ids = list({user_id for user_id, _ in rows})
+            for index in range(0, len(user_ids), 500):
+                part = user_ids[index: index + 500]
+                await cursor.execute(f'SELECT user_id FROM `{PARTICIPANTS}` WHERE lottery_id = ? '
+                                     f'AND user_id IN ({", ".join("?" * len(part))})', (lottery_id, *part))
+                existing.update(user_id for user_id, in await cursor.fetchall())
+            inserted = []
+            for user_id, user_name in rows:
+                if user_id not in existing:
+                    existing.add(user_id)
+                    inserted.append((user_id, user_name))
+            await cursor.executemany(f'INSERT INTO `{PARTICIPANTS}` (user_id, user_name, lottery_id) VALUES (?, ?, ?)',
+                                     [(user_id, user_name, lottery_id) for user_id, user_name in inserted])
+        return inserted
+
+    async def load_participants(self, lottery_id: int) -> list[Row]:
+        return await self.aiodb.select(PARTICIPANTS, '*', lottery_id=lottery_id)
+
+    async def iter_participants(self, lottery_id: int, chunk_size: int = 1000) -> AsyncIterator[list[Row]]:
+        async for rows in self.aiodb.iterate(PARTICIPANTS, '*', chunk_size, lottery_id=lottery_id):
+            yield rows
+
+    async def get_latest_participant(self, user_id: int) -> Optional[Row]:
+        sql = f'SELECT * FROM `{PARTICIPANTS}` WHERE user_id = ? ORDER BY id DESC'
+        return await self.aiodb.fetchone(sql, (user_id,))
+
+    async def set_participant_prize(self, participant_id: int, prize: str):
+        await self.aiodb.update(PARTICIPANTS, prize=prize, id=participant_id)
+
+    async def set_winners(self, lottery_id: int, winners: list[tuple[int, str]]):
+        # 在同一个事务里清空并写入中奖信息，避免开奖中断后只写入部分中奖者
+        async with self.aiodb.transaction() as cursor:
+            await cursor.execute(f'UPDATE `{PARTICIPANTS}` SET prize = NULL WHERE lottery_id = ?', (lottery_id,))
+            await cursor.executemany(f'UPDATE `{PARTICIPANTS}` SET prize = ? WHERE id = ?',
+                                     [(prize, participant_id) for participant_id, prize in winners])
+
+    async def add_temp_message(self, chat_id: int, message_id: int, delete_at: int):
+        await self.aiodb.add(TEMP_MESSAGES, chat_id=chat_id, message_id=message_id, delete_at=delete_at)
+
+    async def remove_temp_message(self, chat_id: int, message_id: int):
+        await self.aiodb.remove(TEMP_MESSAGES, chat_id=chat_id, message_id=message_id)
+
+    async def load_temp_messages(self) -> list[Row]:
+        return await self.aiodb.data(TEMP_MESSAGES)
+
+    async def add_deliveries(self, lottery_id: int, next_at: int):
+        sql = f'INSERT OR IGNORE INTO `{DELIVERIES}` ' \
+              f'(participant_id, lottery_id, user_id, status, attempts, next_at) ' \
+              f'SELECT id, lottery_id, user_id, 0, 0, ? FROM `{PARTICIPANTS}` ' \
+              f'WHERE lottery_id = ? AND prize IS NOT NULL'
+        await self.aiodb.execute(sql, (next_at, lottery_id))
+
+    async def load_pending_deliveries(self, lottery_id: int = None) -> list[Row]:
+        sql = f'SELECT d.id, d.user_id, d.attempts, d.next_at, l.title, p.prize FROM `{DELIVERIES}` d ' \
+              f'JOIN `{PARTICIPANTS}` p ON p.id = d.participant_id ' \
+              f'JOIN `{LOTTERIES}` l ON l.id = d.lottery_id ' \
+              f'WHERE d.status = 0 AND p.prize IS NOT NULL'
+        params = ()
+        if lottery_id is not None:
+            sql += ' AND d.lottery_id = ?'
+            params = (lottery_id,)
+        return await self.aiodb.fetchall(sql + ' ORDER BY d.next_at', params)
+
+    async def update_delivery(self, delivery_id: int, **kwargs):
+        await self.aiodb.update(DELIVERIES, **kwargs, id=delivery_id)
+
+    async def get_prize_by_user(self, user_id: int) -> Optional[Row]:
+        sql = 'SELECT p.lottery_id, l.title, p.prize FROM `{}` p ' \
+              'LEFT JOIN `{}` l ON l.id = p.lottery_id WHERE p.user_id = ? ORDER BY p.id DESC LIMIT 1'
+        row = await self.aiodb.fetchone(sql.format(PARTICIPANTS, LOTTERIES), (user_id,))
+        if row is None and self.has_archive:
+            # 已归档抽奖的中奖者仍可以领取奖品
+            row = await self.aiodb.fetchone(
+                sql.format(PARTICIPANTS + ARCHIVE_SUFFIX, LOTTERIES + ARCHIVE_SUFFIX), (user_id,))
+        return row
+
+    async def add_events(self, rows: list[tuple]):
+        await self.aiodb.add_many(EVENTS, ('lottery_id', 'chat_id', 'type', 'payload', 'created_at'), rows)
+
+
+class MemoryTable(object):
+    def __init__(self, columns: dict):
+        self.columns = list(columns.keys())
+        self.index = {name: i for i, name in enumerate(self.columns)}
+        self.rows: dict[int, list] = dict()
+        self.next_id = 1
+
+    def insert(self, **kwargs) -> list:
+        row = [None] * len(self.columns)
+        row[0] = self.next_id
+        for k, v in kwargs.items():
+            row[self.index[k]] = v
+        self.rows[self.next_id] = row
+        self.next_id += 1
+        return row
+
+    def update(self, row_id: int, **kwargs):
+        row = self.rows.get(row_id)
+        if row is None:
+            return
+        for k, v in kwargs.items():
+            row[self.index[k]] = v
+
+    def dump(self) -> dict:
+        return dict(next_id=self.next_id, rows=list(self.rows.values()))
+
+    def restore(self, raw: dict):
+        self.next_id = raw['next_id']
+        self.rows = {row[0]: row for row in raw['rows']}
+
+
+# 纯内存存储，可用于测试和压测，也可以在高并发参与时以定时快照的方式持久化
+class MemoryStorage(Storage):
+    def __init__(self, snapshot_path: str = None, snapshot_interval: int = 60):
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.lotteries = MemoryTable(LOTTERY_COLUMNS)
+        self.participants = MemoryTable(PARTICIPANT_COLUMNS)
+        self.temp_messages = MemoryTable(TEMP_MESSAGE_COLUMNS)
+        self.deliveries = MemoryTable(DELIVERY_COLUMNS)
+        # 事件只追加不查询，不保留在内存中，随快照追加写入 events_path
+        self.events_path = f'{os.path.splitext(snapshot_path)[0]}.events.jsonl' if snapshot_path else None
+        self.pending_events: list[tuple] = []
+        # chat_id -> 抽奖ID, lottery_id -> 参与人员ID, user_id -> 参与人员ID
+        self.chat_lotteries: dict[int, list[int]] = dict()
+        self.lottery_participants: dict[int, list[int]] = dict()
+        self.user_participants: dict[int, list[int]] = dict()
+        self.unique_participants: set[tuple] = set()
+        self.delivered_participants: set[int] = set()
+        self._snapshot_task: Optional[asyncio.Task] = None
+
+    async def open(self):
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                self.restore(json.load(f))
+        if self.snapshot_path and self.snapshot_interval > 0:
+            self._snapshot_task = asyncio.create_task(self._snapshot_loop())
+        return self
+
+    async def close(self):
+        self._snapshot_task and self._snapshot_task.cancel()
+        await self.snapshot()
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            await self.snapshot()
+
+    async def snapshot(self):
+        if not self.snapshot_path:
+            return
+        # 在事件循环中只取出行的引用，序列化和写文件放到线程中执行
+        # 每批行在一次 json.dumps 中编码，单行是一致的，快照期间新增的行留到下次快照
+        raw = dict(
+            lotteries=self.lotteries.dump(),
+            participants=self.participants.dump(),
+            temp_messages=self.temp_messages.dump(),
+            deliveries=self.deliveries.dump(),
+        )
+        events, self.pending_events = self.pending_events, []
+        await asyncio.to_thread(self._write_snapshot, raw, events)
+
+    def _write_snapshot(self, raw: dict, events: list[tuple]):
+        temp_path = f'{self.snapshot_path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            # json 的 C 编码器在整个调用期间持有 GIL，分批编码让事件循环可以在批次之间运行
+            for i, (name, table) in enumerate(raw.items()):
+                f.write(f'{"{" if i == 0 else ", "}"{name}": {{"next_id": {table["next_id"]}, "rows": [')
+                rows = table['rows']
+                for index in range(0, len(rows), SNAPSHOT_CHUNK_SIZE):
+                    index and f.write(', ')
+                    f.write(json.dumps(rows[index: index + SNAPSHOT_CHUNK_SIZE], ensure_ascii=False)[1: -1])
+                f.write(']}')
+            f.write('}')
+        os.replace(temp_path, self.snapshot_path)
+        if not events:
+            return
+        columns = list(EVENT_COLUMNS.keys())[1:]
+        with open(self.events_path, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in events)
+
+    def restore(self, raw: dict):
+        self.lotteries.restore(raw['lotteries'])
+        self.participants.restore(raw['participants'])
+        self.temp_messages.restore(raw['temp_messages'])
+        'deliveries' in raw and self.deliveries.restore(raw['deliveries'])
+        # 旧版本快照中的事件在下次快照时转存到 events_path
+        'events' in raw and self.pending_events.extend(tuple(row[1:]) for row in raw['events']['rows'])
+        self.chat_lotteries.clear()
+        self.lottery_participants.clear()
+        self.user_participants.clear()
+        self.unique_participants.clear()
+        self.delivered_participants = {row[1] for row in self.deliveries.rows.values()}
+        for row in self.lotteries.rows.values():
+            self.chat_lotteries.setdefault(row[1], []).append(row[0])
+        for row in self.participants.rows.values():
+            self._index_participant(row)
+
+    def _index_participant(self, row: list):
+        _id, user_id, user_name, lottery_id, _ = row
+        self.lottery_participants.setdefault(lottery_id, []).append(_id)
+        self.user_participants.setdefault(user_id, []).append(_id)
+        self.unique_participants.add((user_id, lottery_id))
+
+    def _status_index(self):
+        return self.lotteries.index['status']
+
+    async def add_lottery(self, **kwargs) -> int:
+        row = self.lotteries.insert(**kwargs)
+        self.chat_lotteries.setdefault(row[1], []).append(row[0])
+        return row[0]
+
+    async def update_lottery(self, lottery_id: int, **kwargs):
+        self.lotteries.update(lottery_id, **kwargs)
+
+    async def swap_lottery_status(self, lottery_id: int, status: int, expected: list) -> bool:
+        row = self.lotteries.rows.get(lottery_id)
+        if row is None or row[self._status_index()] not in expected:
+            return False
+        row[self._status_index()] = status
+        return True
+
+    async def remove_lottery(self, lottery_id: int):
+        row = self.lotteries.rows.pop(lottery_id, None)
+        row and self.chat_lotteries.get(row[1], []).remove(lottery_id)
+
+    async def get_lottery(self, lottery_id: int) -> Optional[Row]:
+        row = self.lotteries.rows.get(lottery_id)
+        return tuple(row) if row else None
+
+    async def find_lottery(self, chat_id: int, status: list) -> Optional[Row]:
+        index = self._status_index()
+        for lottery_id in reversed(self.chat_lotteries.get(chat_id, [])):
+            row = self.lotteries.rows[lottery_id]
+            if row[index] in status:
+                return tuple(row)
+        return None
+
+    async def find_lotteries(self, status: list) -> list[Row]:
+        index = self._status_index()
+        return [tuple(row) for row in self.lotteries.rows.values() if row[index] in status]
+
+    async def add_participant(self, user_id: int, user_name: str, lottery_id: int):
+        if (user_id, lottery_id) in self.unique_participants:
+            raise sqlite3.IntegrityError('UNIQUE constraint failed: participants.user_id, participants.lottery_id')
+        self._index_participant(self.participants.insert(user_id=user_id, user_name=user_name, lottery_id=lottery_id))
+
+    async def add_participants(self, lottery_id: int, rows: list[tuple[int, str]]) -> list[tuple[int, str]]:
+        inserted = []
+        for user_id, user_name in rows:
+            if (user_id, lottery_id) in self.unique_participants:
+                continue
+            self._index_participant(
+                self.participants.insert(user_id=user_id, user_name=user_name, lottery_id=lottery_id))
+            inserted.append((user_id, user_name))
+        return inserted
+
+    async def load_participants(self, lottery_id: int) -> list[Row]:
+        rows = self.participants.rows
+        return [tuple(rows[_id]) for _id in self.lottery_participants.get(lottery_id, [])]
+
+    async def iter_participants(self, lottery_id: int, chunk_size: int = 1000) -> AsyncIterator[list[Row]]:
+        ids = self.lottery_participants.get(lottery_id, [])
+        rows = self.participants.rows
+        for index in range(0, len(ids), chunk_size):
+            yield [tuple(rows[_id]) for _id in ids[index: index + chunk_size]]
+
+    async def get_latest_participant(self, user_id: int) -> Optional[Row]:
+        ids = self.user_participants.get(user_id)
+        return tuple(self.participants.rows[ids[-1]]) if ids else None
+
+    async def set_participant_prize(self, participant_id: int, prize: str):
+        self.participants.update(participant_id, prize=prize)
+
+    async def set_winners(self, lottery_id: int, winners: list[tuple[int, str]]):
+        for participant_id in self.lottery_participants.get(lottery_id, []):
+            self.participants.update(participant_id, prize=None)
+        for participant_id, prize in winners:
+            self.participants.update(participant_id, prize=prize)
+
+    async def add_temp_message(self, chat_id: int, message_id: int, delete_at: int):
+        self.temp_messages.insert(chat_id=chat_id, message_id=message_id, delete_at=delete_at)
+
+    async def remove_temp_message(self, chat_id: int, message_id: int):
+        for row in list(self.temp_messages.rows.values()):
+            if row[1] == chat_id and row[2] == message_id:
+                del self.temp_messages.rows[row[0]]
+
+    async def load_temp_messages(self) -> list[Row]:
+        return [tuple(row) for row in self.temp_messages.rows.values()]
+
+    async def add_deliveries(self, lottery_id: int, next_at: int):
+        rows = self.participants.rows
+        for participant_id in self.lottery_participants.get(lottery_id, []):
+            _, user_id, _, _, prize = rows[participant_id]
+            if prize is None or participant_id in self.delivered_participants:
+                continue
+            self.delivered_participants.add(participant_id)
+            self.deliveries.insert(participant_id=participant_id, lottery_id=lottery_id, user_id=user_id,
+                                   status=0, attempts=0, next_at=next_at)
+
+    async def load_pending_deliveries(self, lottery_id: int = None) -> list[Row]:
+        pending = []
+        for _id, participant_id, _lottery_id, user_id, status, attempts, next_at, _ in self.deliveries.rows.values():
+            if status != 0 or (lottery_id is not None and _lottery_id != lottery_id):
+                continue
+            participant = self.participants.rows.get(participant_id)
+            lottery = self.lotteries.rows.get(_lottery_id)
+            if participant is None or lottery is None or participant[4] is None:
+                continue
+            pending.append((_id, user_id, attempts, next_at, lottery[3], participant[4]))
+        return sorted(pending, key=lambda x: x[3])
+
+    async def update_delivery(self, delivery_id: int, **kwargs):
+        self.deliveries.update(delivery_id, **kwargs)
+
+    async def get_prize_by_user(self, user_id: int) -> Optional[Row]:
+        ids = self.user_participants.get(user_id)
+        if not ids:
+            return None
+        participant = self.participants.rows[ids[-1]]
+        lottery = self.lotteries.rows.get(participant[3])
+        return participant[3], lottery[3] if lottery else None, participant[4]
+
+    async def add_events(self, rows: list[tuple]):
+        # 未设置快照路径时事件不保存
+        self.events_path and self.pending_events.extend(rows)
+
+
+def create_storage(app_name: str, engine: str = 'sqlite', snapshot_interval: int = 60,
+                   backup_interval: int = 0) -> Storage:
+    if engine == 'memory':
+        return MemoryStorage(f'db/{app_name}.json', snapshot_interval)
+    if engine == 'sqlite':
+        return SqliteStorage(f'db/{app_name}.db', backup_interval)
+    raise ValueError(f'Unknown storage engine: {engine}')
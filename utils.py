@@ -1,30 +1,52 @@
 import asyncio
-from typing import TypedDict, Union, Optional
+import csv
+import json
+import time
+from typing import TypedDict, Union, Optional, Iterable, Iterator, Callable, Awaitable
 from urllib.parse import urlparse, parse_qs
-from dblite import aioDbLite
+from storage import Storage, create_storage, LOTTERIES, PARTICIPANTS, TEMP_MESSAGES, DELIVERIES
 
 __all__ = [
     'LotteryType',
     'make_lottery',
     'ParticipantType',
     'make_participant',
+    'TempMessageType',
+    'make_temp_message',
+    'DeliveryType',
+    'make_delivery',
     'get_db_connect',
     'remove_lottery_by_id',
     'load_lottery',
     'load_lottery_by_id',
+    'load_lotteries_by_status',
     'set_lottery',
+    'swap_lottery_status',
     'add_lottery',
     'add_participant',
     'load_participants',
+    'default_user_name',
+    'read_participant_rows',
+    'import_participants',
+    'export_participants',
     'set_winner_prize',
+    'set_winners_prize',
     'get_winner_by_user',
+    'add_temp_message',
+    'remove_temp_message',
+    'load_temp_messages',
+    'add_deliveries',
+    'load_pending_deliveries',
+    'set_delivery',
+    'get_prize_by_user',
     'int2number',
     'lottery_status2message',
     'lottery_winner2message',
     'lottery2message',
     'get_query_string',
     'prize2message',
-    'url2dict'
+    'url2dict',
+    'StartupProfiler'
 ]
 
 
@@ -35,7 +57,7 @@ class LotteryType(TypedDict):
     creator_id: int
     # 抽奖标题
     title: str
-    # 抽奖状态 0 已暂停 1 抽奖中 2 已结束
+    # 抽奖状态 0 已暂停 1 抽奖中 2 已结束 3 开奖中
     status: int
     # 开奖人数 大于 0 将启用自动开奖
     drawn_people: int
@@ -49,7 +71,7 @@ class LotteryType(TypedDict):
     prize: str
 
 
-LotteryType.TABLE_NAME = 'lotteries'
+LotteryType.TABLE_NAME = LOTTERIES
 
 
 def make_lottery(raw: Union[list, tuple]) -> LotteryType:
@@ -79,7 +101,7 @@ class ParticipantType(TypedDict):
     prize: str
 
 
-ParticipantType.TABLE_NAME = 'participants'
+ParticipantType.TABLE_NAME = PARTICIPANTS
 
 
 def make_participant(raw: Union[list, tuple]) -> ParticipantType:
@@ -93,64 +115,86 @@ def make_participant(raw: Union[list, tuple]) -> ParticipantType:
     )
 
 
+class TempMessageType(TypedDict):
+    id: int
+    chat_id: int
+    message_id: int
+    # 计划删除的时间戳(秒)
+    delete_at: int
+
+
+TempMessageType.TABLE_NAME = TEMP_MESSAGES
+
+
+def make_temp_message(raw: Union[list, tuple]) -> TempMessageType:
+    _id, chat_id, message_id, delete_at = raw
+    return TempMessageType(
+        id=_id,
+        chat_id=chat_id,
+        message_id=message_id,
+        delete_at=delete_at
+    )
+
+
+class DeliveryType(TypedDict):
+    id: int
+    user_id: int
+    # 已尝试发送次数
+    attempts: int
+    # 下次发送的时间戳(秒)
+    next_at: int
+    # 抽奖标题
+    title: str
+    # 奖品内容
+    prize: str
+
+
+DeliveryType.TABLE_NAME = DELIVERIES
+
+
+def make_delivery(raw: Union[list, tuple]) -> DeliveryType:
+    _id, user_id, attempts, next_at, title, prize = raw
+    return DeliveryType(
+        id=_id,
+        user_id=user_id,
+        attempts=attempts,
+        next_at=next_at,
+        title=title,
+        prize=prize
+    )
+
+
 _title = "❤️‍🔥❤️‍🔥❤️‍🔥❤️‍🔥**{}**❤️‍🔥❤️‍🔥❤️‍🔥❤️‍🔥"
 _footer = "❤️‍🔥❤️‍🔥❤️‍🔥❤️‍🔥❤️‍🔥❤️‍🔥❤️‍🔥❤️‍🔥❤️‍🔥❤️‍🔥"
 numbers = ['0️⃣', '1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣', '7️⃣', '8️⃣', '9️⃣']
-lottery_status = ['已暂停', '抽奖中', '已结束']
-
-
-async def get_db_connect(app_name: str):
-    aiodb = await aioDbLite(f'db/{app_name}.db')
-    await aiodb.create(
-        LotteryType.TABLE_NAME,
-        id='INTEGER PRIMARY KEY AUTOINCREMENT',
-        chat_id='int',
-        message_id='int',
-        title='TEXT NOT NULL',
-        status='int(1)',  # 抽奖状态 0 已暂停 1 抽奖中 2 已结束
-        drawn_people='int',  # 开奖人数 为 null 或者 0 时 不自动开奖
-        winner_people='varchar(255)',  # 数字或者百分比
-        password='varchar(1024)',  # 参与抽奖口令
-        same_prize='int(1)',  # 1 相同的奖品  0 每个人都不一样
-        prize='TEXT',  # 奖品
-        creator_id='int',  # 创建人ID
-    )
-    await aiodb.create(
-        ParticipantType.TABLE_NAME,
-        id='INTEGER PRIMARY KEY AUTOINCREMENT',
-        user_id='int',
-        user_name='varchar(1024)',
-        lottery_id='int',  # 本轮抽奖ID
-        prize='TEXT',  # 奖品
-    )
-    sql = f'CREATE UNIQUE INDEX IF NOT EXISTS idx_unique_users_lottery ON {ParticipantType.TABLE_NAME} ' \
-          f'(user_id, user_name, lottery_id);'
-    await aiodb.cursor.execute(sql)
-    await aiodb.conn.commit()
-    return aiodb
+lottery_status = ['已暂停', '抽奖中', '已结束', '开奖中']
+
+
+async def get_db_connect(app_name: str, engine: str = 'sqlite', snapshot_interval: int = 60,
+                         backup_interval: int = 0) -> Storage:
+    return await create_storage(app_name, engine, snapshot_interval, backup_interval).open()
 
 
-async def load_lottery_by_id(aiodb: aioDbLite, lottery_id: int) -> LotteryType:
-    sql = 'SELECT * FROM `lotteries` WHERE id = ?'
-    cursor = await aiodb.cursor.execute(sql, (lottery_id,))
-    lotteries_raw = await cursor.fetchone()
+async def load_lottery_by_id(storage: Storage, lottery_id: int) -> LotteryType:
+    lotteries_raw = await storage.get_lottery(lottery_id)
     return make_lottery(lotteries_raw) if lotteries_raw else None
 
 
-async def load_lottery(aiodb: aioDbLite, chat_id: int, status: list = None) -> LotteryType:
+async def load_lottery(storage: Storage, chat_id: int, status: list = None) -> LotteryType:
     status = status or [0, 1]
-    status = (status * 2)[0: 2]
-    sql = 'SELECT * FROM `lotteries` WHERE chat_id = ? AND (status = ? OR status = ?) ORDER BY id DESC'
-    cursor = await aiodb.cursor.execute(sql, (chat_id, *status))
-    lotteries_raw = await cursor.fetchone()
+    lotteries_raw = await storage.find_lottery(chat_id, status)
     return make_lottery(lotteries_raw) if lotteries_raw else None
 
 
-async def remove_lottery_by_id(aiodb: aioDbLite, lottery_id: int):
-    await aiodb.remove(LotteryType.TABLE_NAME, id=lottery_id)
+async def load_lotteries_by_status(storage: Storage, status: list) -> list[LotteryType]:
+    return list(map(make_lottery, await storage.find_lotteries(status)))
 
 
-async def set_lottery(aiodb: aioDbLite, lottery_id: int, **kwargs):
+async def remove_lottery_by_id(storage: Storage, lottery_id: int):
+    await storage.remove_lottery(lottery_id)
+
+
+async def set_lottery(storage: Storage, lottery_id: int, **kwargs):
     title = kwargs.get('title')
     status = kwargs.get('status')
     drawn_people = kwargs.get('drawn_people')
@@ -178,15 +222,16 @@ async def set_lottery(aiodb: aioDbLite, lottery_id: int, **kwargs):
         updater['message_id'] = message_id
     if len(updater.values()) == 0:
         return
-    # where
-    updater['id'] = lottery_id
-    await aiodb.update(LotteryType.TABLE_NAME, **updater)
+    await storage.update_lottery(lottery_id, **updater)
+
+
+async def swap_lottery_status(storage: Storage, lottery_id: int, status: int, expected: list) -> bool:
+    return await storage.swap_lottery_status(lottery_id, status, expected)
 
 
-async def add_lottery(aiodb: aioDbLite, chat_id, message_id, title, status=0, drawn_people=15,
+async def add_lottery(storage: Storage, chat_id, message_id, title, status=0, drawn_people=15,
                       winner_people='10', password='免费参与', same_prize=0, prize='', creator_id=None):
-    await aiodb.add(
-        LotteryType.TABLE_NAME,
+    return await storage.add_lottery(
         chat_id=chat_id,
         message_id=message_id,
         title=title,
@@ -200,41 +245,146 @@ async def add_lottery(aiodb: aioDbLite, chat_id, message_id, title, status=0, dr
     )
 
 
-async def add_participant(aiodb: aioDbLite, user_id, user_name, **kwargs):
+async def add_participant(storage: Storage, user_id, user_name, **kwargs):
     lottery_id = kwargs.get('lottery_id')
     if lottery_id is None:
         chat_id = kwargs.get('chat_id')
         if chat_id is None:
             return None
-        lottery = await load_lottery(aiodb, chat_id, [1])
+        lottery = await load_lottery(storage, chat_id, [1])
         if lottery is None:
             return None
         lottery_id = lottery['id']
-    await aiodb.add(
-        ParticipantType.TABLE_NAME,
-        user_id=user_id,
-        user_name=user_name,
-        lottery_id=lottery_id,
-    )
+    await storage.add_participant(user_id, user_name, lottery_id)
     return lottery_id
 
 
-async def set_winner_prize(aiodb: aioDbLite, participant_id: int, prize: str):
-    await aiodb.update(ParticipantType.TABLE_NAME, prize=prize, id=participant_id)
+async def set_winner_prize(storage: Storage, participant_id: int, prize: str):
+    await storage.set_participant_prize(participant_id, prize)
+
 
+async def set_winners_prize(storage: Storage, lottery_id: int, winners: list[tuple[int, str]]):
+    await storage.set_winners(lottery_id, winners)
 
-async def get_winner_by_user(aiodb: aioDbLite, user_id: int) -> ParticipantType:
-    sql = f'SELECT * FROM `{ParticipantType.TABLE_NAME}` WHERE user_id = ? ORDER BY id DESC'
-    cursor = await aiodb.cursor.execute(sql, (user_id,))
-    participant_raw = await cursor.fetchone()
+
+async def get_winner_by_user(storage: Storage, user_id: int) -> ParticipantType:
+    participant_raw = await storage.get_latest_participant(user_id)
     return make_participant(participant_raw) if participant_raw else None
 
 
-async def load_participants(aiodb: aioDbLite, lottery_id: int):
-    participant_raw = await aiodb.select(ParticipantType.TABLE_NAME, '*', lottery_id=lottery_id)
+async def load_participants(storage: Storage, lottery_id: int):
+    participant_raw = await storage.load_participants(lottery_id)
     return list(map(make_participant, participant_raw))
 
 
+async def add_temp_message(storage: Storage, chat_id: int, message_id: int, delete_at: int):
+    await storage.add_temp_message(chat_id, message_id, delete_at)
+
+
+async def remove_temp_message(storage: Storage, chat_id: int, message_id: int):
+    await storage.remove_temp_message(chat_id, message_id)
+
+
+async def load_temp_messages(storage: Storage) -> list[TempMessageType]:
+    return list(map(make_temp_message, await storage.load_temp_messages()))
+
+
+async def add_deliveries(storage: Storage, lottery_id: int):
+    await storage.add_deliveries(lottery_id, int(time.time()))
+
+
+async def load_pending_deliveries(storage: Storage, lottery_id: int = None) -> list[DeliveryType]:
+    return list(map(make_delivery, await storage.load_pending_deliveries(lottery_id)))
+
+
+async def set_delivery(storage: Storage, delivery_id: int, **kwargs):
+    await storage.update_delivery(delivery_id, **kwargs)
+
+
+async def get_prize_by_user(storage: Storage, user_id: int) -> tuple[Optional[int], Optional[str], Optional[str]]:
+    raw = await storage.get_prize_by_user(user_id)
+    return raw if raw else (None, None, None)
+
+
+def default_user_name(user_id: int) -> str:
+    return 'U%x' % user_id
+
+
+def json_participant_row(row) -> list:
+    # 支持 {"user_id": 1, "user_name": "a"} 或 [1, "a"]，其它内容按无效行跳过
+    if isinstance(row, dict):
+        return [row.get('user_id'), row.get('user_name')]
+    if isinstance(row, list):
+        return (row + [None, None])[0: 2]
+    return [None, None]
+
+
+def read_participant_rows(path: str) -> Iterator[tuple[int, str]]:
+    # 逐行读取 CSV 或 JSONL 文件，每行需包含 user_id，user_name 可选
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        if path.lower().endswith(('.jsonl', '.json')):
+            rows = (json_participant_row(json.loads(line)) for line in f if line.strip())
+        else:
+            rows = ((row + [None])[0: 2] for row in csv.reader(f) if row)
+        for user_id, user_name in rows:
+            user_id = str(user_id).strip()
+            # 跳过表头及无效行
+            if not user_id.lstrip('-').isdigit():
+                continue
+            user_id = int(user_id)
+            # 超出 sqlite INTEGER(有符号 64 位) 范围的 user_id 无法写入，按无效行跳过
+            if not -2 ** 63 <= user_id < 2 ** 63:
+                continue
+            user_name = str(user_name).strip() if user_name else ''
+            yield user_id, user_name or default_user_name(user_id)
+
+
+async def import_participants(
+        storage: Storage,
+        lottery_id: int,
+        rows: Iterable[tuple[int, str]],
+        chunk_size: int = 1000,
+        progress: Callable[[int, int], Awaitable] = None,
+        on_chunk: Callable[[list[tuple[int, str]]], None] = None
+) -> tuple[int, int]:
+    total = inserted = 0
+    chunk = []
+
+    async def flush():
+        nonlocal inserted
+        # 已参与的用户按 user_id 忽略，on_chunk 只收到实际写入的 (user_id, user_name)
+        rows = await storage.add_participants(lottery_id, chunk)
+        inserted += len(rows)
+        rows and on_chunk and on_chunk(rows)
+        chunk.clear()
+        progress and (await progress(total, inserted))
+
+    for user_id, user_name in rows:
+        chunk.append((user_id, user_name))
+        total += 1
+        if len(chunk) >= chunk_size:
+            await flush()
+    if chunk:
+        await flush()
+    return total, inserted
+
+
+async def export_participants(storage: Storage, lottery_id: int, path: str, chunk_size: int = 1000) -> int:
+    count = 0
+    is_jsonl = path.lower().endswith('.jsonl')
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        is_jsonl or writer.writerow(['user_id', 'user_name', 'prize'])
+        async for rows in storage.iter_participants(lottery_id, chunk_size):
+            if is_jsonl:
+                f.writelines(json.dumps(dict(user_id=user_id, user_name=user_name, prize=prize),
+                                        ensure_ascii=False) + '\n' for _, user_id, user_name, _, prize in rows)
+            else:
+                writer.writerows((user_id, user_name, prize) for _, user_id, user_name, _, prize in rows)
+            count += len(rows)
+    return count
+
+
 def int2number(n: int) -> str:
     return ''.join(map(lambda i: numbers[int(i)], list(str(n))))
 
@@ -301,3 +451,20 @@ def url2dict(url: str) -> Optional[dict[str, str]]:
         return None
     parser = urlparse(url)
     return dict(scheme=parser.scheme, hostname=parser.hostname, port=parser.port)
+
+
+class StartupProfiler(object):
+    def __init__(self, started: float = None):
+        self.started = started or time.perf_counter()
+        self.phases: list[tuple[str, float]] = []
+        self._last = self.started
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self) -> str:
+        lines = [f'    {phase:<24}{elapsed * 1000:>10.1f} ms' for phase, elapsed in self.phases]
+        lines.append(f'    {"total":<24}{(self._last - self.started) * 1000:>10.1f} ms')
+        return '\n'.join(lines)